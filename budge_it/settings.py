@@ -61,8 +61,15 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'budget.views.post_data',
+    'budget.views.recurrence_scheduler',
+    'budget.instrumentation.query_accounting',
+    'budget.profiling.sampling_profiler',
 ]
 
+# Profile one in this many requests, see profile_report
+PROFILE_EVERY = int(environ.get('PROFILE_EVERY', 0))
+PROFILE_HEADER = 'X-Profile'
+
 ROOT_URLCONF = 'budge_it.urls'
 
 TEMPLATES: Any = [
@@ -123,6 +130,17 @@ else:
 DATABASES = dbs
 CONN_MAX_AGE = None
 
+# Shared between processes, since cached budget directories are invalidated
+# when accounts change
+if 'PROD' in environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/var/tmp/budget_cache',
+        }
+    }
+    PROFILE_DIR = '/var/tmp/budget_profiles'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -211,6 +229,15 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'budget': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # A JSON line of timings per request
+        'budget.timing': {
+            'level': 'INFO' if 'PROD' in environ else 'WARNING',
+        },
     },
 }
 
@@ -14,7 +14,8 @@ from .models import (Id, Budget, BaseAccount, Account, Category, Balance,
                      TransactionPart, Transaction, AccountLike, Row,
                      AccountT,
                      MultiTransaction,
-                     budgeting_categories)
+                     budgeting_categories, remap_entries,
+                     set_entries_many)
 from .recurrence import RRule
 
 
@@ -254,8 +255,7 @@ class TransactionForm(forms.ModelForm, FormSetInline):
         return instance
 
 
-def _update_part_with(budget: Budget, part: TransactionPart,
-                      changes: dict[Any, Any]):
+def _changed_entries(part: TransactionPart, changes: dict[Any, Any]):
     init_accounts, init_categories = part.entries()
     accounts: dict[Account, int] = defaultdict(int)
     for account, amount in init_accounts.items():
@@ -263,17 +263,7 @@ def _update_part_with(budget: Budget, part: TransactionPart,
     categories: dict[Category, int] = defaultdict(int)
     for category, amount in init_categories.items():
         categories[changes.get(category, category)] += amount
-    return part.set_entries(budget, accounts, categories)
-
-
-def _update_transaction_with(budget: Budget, transaction: Transaction,
-                             changes: dict[Any, Any]):
-    parts = [_update_part_with(budget, part, changes)
-             for part in transaction.visible_parts]
-    if not any(parts) and not transaction.invisible_parts:
-        transaction.delete()
-    else:
-        return transaction
+    return accounts, categories
 
 
 class BaseMultiFormSet(forms.BaseFormSet):
@@ -296,11 +286,22 @@ class BaseMultiFormSet(forms.BaseFormSet):
                 before = _to_account(type, form.initial[field], currency)
                 after = _to_account(type, form.cleaned_data[field], currency)
                 changes[before] = after
-        transactions = [
-            _update_transaction_with(self.budget, transaction, changes)
-            for transaction in self.instance.contents]
-        self.instance.contents = [
-            transaction for transaction in transactions if transaction]
+        parts = list(chain(*(transaction.visible_parts
+                             for transaction in self.instance.contents)))
+        remapped = remap_entries(parts, changes)
+        rest = [part for part in parts if part not in remapped]
+        updated = set_entries_many(
+            self.budget,
+            [(part, *_changed_entries(part, changes)) for part in rest])
+        kept = remapped | {part for part in updated if part}
+        transactions = []
+        for edited in self.instance.contents:
+            if (any(part in kept for part in edited.visible_parts)
+                    or edited.invisible_parts):
+                transactions.append(edited)
+            else:
+                edited.delete()
+        self.instance.contents = transactions
         return self.instance
 
 
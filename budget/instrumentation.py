@@ -0,0 +1,234 @@
+"""Counting the queries that views make, to catch N+1 query patterns, and
+timing the phases of each request."""
+import json
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+
+logger = logging.getLogger(__name__)
+timing_logger = logging.getLogger('budget.timing')
+
+View = TypeVar('View', bound=Callable[..., HttpResponse])
+
+
+@dataclass
+class QueryCount:
+    """The number of queries run while this is installed, and their time."""
+    queries: int = 0
+    seconds: float = 0
+
+    def __call__(self, execute: Callable[..., Any], sql: str, params: Any,
+                 many: bool, context: dict[str, Any]):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def count_queries() -> Iterator[QueryCount]:
+    """Count the queries on all databases, without needing DEBUG."""
+    count = QueryCount()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(count))
+        yield count
+
+
+def query_budget(default: int, **overrides: int) -> Callable[[View], View]:
+    """Declare how many queries a view should need. 'overrides' are keyed by
+    request method (other than GET) or by HX-Target, in that order."""
+    def decorate(view: View) -> View:
+        view.query_budget = {None: default, **overrides}  # type: ignore
+        return view
+    return decorate
+
+
+@dataclass
+class ViewStats:
+    requests: int = 0
+    queries: int = 0
+    seconds: float = 0
+    most_queries: int = 0
+
+
+_stats: dict[str, ViewStats] = {}
+_stats_lock = threading.Lock()
+
+
+def view_key(request: HttpRequest) -> str:
+    """Name a request by its view, HX-Target and method."""
+    match = request.resolver_match
+    key = match.view_name if match else 'unresolved'
+    if target := request.headers.get('HX-Target'):
+        key += f"#{target}"
+    if request.method not in ('GET', 'HEAD'):
+        key = f"{request.method} {key}"
+    return key
+
+
+def budget_for(request: HttpRequest) -> Optional[int]:
+    match = request.resolver_match
+    limits: dict[Optional[str], int] = getattr(
+        match and match.func, 'query_budget', {})
+    for key in (request.method, request.headers.get('HX-Target'), None):
+        if key in limits:
+            return limits[key]
+    return None
+
+
+def view_stats() -> dict[str, ViewStats]:
+    """The queries made by each kind of request since the process started."""
+    with _stats_lock:
+        return {key: ViewStats(**vars(stats)) for key, stats in _stats.items()}
+
+
+@dataclass
+class Phase:
+    """Time spent in a phase, not counting phases nested in it."""
+    calls: int = 0
+    seconds: float = 0
+    db_seconds: float = 0
+    queries: int = 0
+
+    def add(self, other: 'Phase'):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.db_seconds += other.db_seconds
+        self.queries += other.queries
+
+    def __sub__(self, other: 'Phase'):
+        return Phase(self.calls - other.calls, self.seconds - other.seconds,
+                     self.db_seconds - other.db_seconds,
+                     self.queries - other.queries)
+
+
+@dataclass
+class Timings:
+    count: QueryCount
+    start: float = field(default_factory=time.perf_counter)
+    phases: dict[str, Phase] = field(default_factory=dict)
+    # The time in phases nested in each running phase
+    nested: list[Phase] = field(default_factory=list)
+
+    def server_timing(self, total: float) -> str:
+        """The value of the Server-Timing header, in milliseconds. Phases
+        show their time outside the database."""
+        metrics = [f'total;dur={total * 1000:.1f}',
+                   f'db;dur={self.count.seconds * 1000:.1f};'
+                   f'desc="{self.count.queries} queries"']
+        for name, phase in self.phases.items():
+            metrics.append(f'{name};dur='
+                           f'{(phase.seconds - phase.db_seconds) * 1000:.1f};'
+                           f'desc="{phase.calls}x, {phase.queries} queries"')
+        return ', '.join(metrics)
+
+
+_timings: ContextVar[Optional[Timings]] = ContextVar('timings', default=None)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Time a phase of the current request. Also works as a decorator."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    count = timings.count
+    start = Phase(0, time.perf_counter(), count.seconds, count.queries)
+    timings.nested.append(Phase())
+    try:
+        yield
+    finally:
+        total = Phase(1, time.perf_counter(), count.seconds,
+                      count.queries) - start
+        timings.phases.setdefault(name, Phase()).add(
+            total - timings.nested.pop())
+        if timings.nested:
+            timings.nested[-1].add(total)
+
+
+def log_timings(request: HttpRequest, response: HttpResponse,
+                timings: Timings, total: float):
+    """One JSON line per request, to add up offline."""
+    timing_logger.info(json.dumps({
+        'view': view_key(request),
+        'path': request.path,
+        'status': response.status_code,
+        'ms': round(total * 1000, 2),
+        'db_ms': round(timings.count.seconds * 1000, 2),
+        'queries': timings.count.queries,
+        'phases': {name: {'calls': phase.calls,
+                          'ms': round(phase.seconds * 1000, 2),
+                          'db_ms': round(phase.db_seconds * 1000, 2),
+                          'queries': phase.queries}
+                   for name, phase in timings.phases.items()},
+    }))
+
+
+def query_accounting(get_response: Callable[[HttpRequest], HttpResponse]):
+    """Count the queries of each request, and warn when a view makes more
+    than its query_budget(). Also adds a Server-Timing header with the
+    phases that were timed()."""
+    def middleware(request: HttpRequest):
+        with count_queries() as count:
+            timings = Timings(count)
+            token = _timings.set(timings)
+            try:
+                response = get_response(request)
+            finally:
+                _timings.reset(token)
+        total = time.perf_counter() - timings.start
+        response['Server-Timing'] = timings.server_timing(total)
+        log_timings(request, response, timings, total)
+        request.query_count = count  # type: ignore
+        key = view_key(request)
+        with _stats_lock:
+            stats = _stats.setdefault(key, ViewStats())
+            stats.requests += 1
+            stats.queries += count.queries
+            stats.seconds += count.seconds
+            stats.most_queries = max(stats.most_queries, count.queries)
+        limit = budget_for(request)
+        if limit is not None and count.queries > limit:
+            logger.warning("%s made %d queries, over its budget of %d (%s)",
+                           key, count.queries, limit, request.path)
+        return response
+    return middleware
+
+
+def queries_by_size(request: Callable[[], Any], grow: Callable[[int], Any],
+                    sizes: Iterable[int]) -> dict[int, int]:
+    """How many queries 'request' makes after grow(size) has added data, for
+    each size in turn. It's run once first, so lazily created rows and caches
+    don't count."""
+    request()
+    counts: dict[int, int] = {}
+    for size in sizes:
+        grow(size)
+        with count_queries() as count:
+            request()
+        counts[size] = count.queries
+    return counts
+
+
+class QueryCountAssertions:
+    """Test case mixin."""
+
+    def assertQueriesConstant(self, request: Callable[[], Any],
+                              grow: Callable[[int], Any],
+                              sizes: Iterable[int] = (1, 10)):
+        """Fail if 'request' makes more queries as grow() adds data."""
+        counts = queries_by_size(request, grow, sizes)
+        if len(set(counts.values())) > 1:
+            self.fail(  # type: ignore
+                f"Queries grow with the data: {counts}")
@@ -2,7 +2,9 @@ from django.templatetags.static import static
 from django.urls import reverse
 from datetime import date, timedelta
 
-from jinja2 import Environment
+from jinja2 import Environment, Template
+
+from .instrumentation import timed
 
 
 def url(view: str, *args):
@@ -13,8 +15,15 @@ def end_of_month(value: date):
     return (value + timedelta(days=31)).replace(day=1) - timedelta(days=1)
 
 
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with timed('render'):
+            return super().render(*args, **kwargs)
+
+
 def environment(**options):
     env = Environment(**options)
+    env.template_class = TimedTemplate
     env.globals.update(
         {
             "static": static,
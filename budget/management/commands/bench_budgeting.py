@@ -0,0 +1,51 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from typing import Any, Callable
+from datetime import date
+import time
+
+from budget.models import (Budget, months_between,
+                           category_balance, category_balance_from_entries)
+from budget.management.synthetic import synthetic_budget
+
+
+class Command(BaseCommand):
+    help = ("Compare the category month rollup with summing the entries, "
+            "on a synthetic budget")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--years", type=int, default=10)
+        parser.add_argument("--per-month", type=int, default=100,
+                            help="Transactions per month")
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args: Any, years: int, per_month: int, repeat: int,
+               **options: Any):
+        end = date.today().replace(day=1)
+        start = end.replace(year=end.year - years)
+        with transaction.atomic():
+            built = time.perf_counter()
+            budget = synthetic_budget("bench_budgeting", start, end,
+                                      per_month=per_month)
+            self.stdout.write(f"Built {years} years in "
+                              f"{time.perf_counter() - built:.1f}s")
+            months = list(months_between(start, end))
+            results = {}
+            for name, function in (('entries', category_balance_from_entries),
+                                   ('rollup', category_balance)):
+                results[name] = self.time(name, function, budget, months, repeat)
+            transaction.set_rollback(True)
+        if results['entries'] != results['rollup']:
+            raise CommandError("Results differ")
+
+    def time(self, name: str,
+             function: Callable[[Budget, date], 'Any'],
+             budget: Budget, months: list[date], repeat: int):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = [[(category.id, category.balance, category.change)
+                       for category in function(budget, month)]
+                      for month in months]
+        elapsed = (time.perf_counter() - start) / repeat / len(months)
+        self.stdout.write(f"{name}: {elapsed * 1000:.2f}ms per month")
+        return result
@@ -0,0 +1,52 @@
+from django.db import transaction, connection
+from django.db.models import Max
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from typing import Any
+from datetime import date
+import time
+
+from budget.models import Transaction
+from budget.management.synthetic import synthetic_budget
+
+
+class Command(BaseCommand):
+    help = ("Compare loading transaction contents with JSON subqueries and "
+            "with a flat query, on a synthetic budget. Run it with "
+            "DEV_POSTGRES set to measure PostgreSQL.")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--sizes", type=int, nargs="+",
+                            default=[1000, 10000, 100000],
+                            help="Numbers of transactions to load")
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args: Any, sizes: list[int], repeat: int,
+               **options: Any):
+        self.stdout.write(f"Database: {connection.vendor}")
+        for size in sizes:
+            with transaction.atomic():
+                first = Transaction.objects.aggregate(Max('id'))['id__max'] or 0
+                end = date.today().replace(day=1)
+                start = end.replace(year=end.year - 1)
+                # Each month also has an income and a budgeting transaction
+                synthetic_budget(f"bench_loaders_{size}", start, end,
+                                 per_month=max(size // 12 - 2, 0))
+                qs = Transaction.objects.filter(id__gt=first)
+                results = {flat: self.time(qs, flat, size, repeat)
+                           for flat in (False, True)}
+                transaction.set_rollback(True)
+            if results[False] != results[True]:
+                raise CommandError(f"Loaders differ at {size} transactions")
+
+    def time(self, qs: Any, flat: bool, size: int, repeat: int):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            transactions = list(qs.fetch_contents(flat=flat))
+        elapsed = (time.perf_counter() - start) / repeat
+        name = 'flat' if flat else 'json'
+        self.stdout.write(f"{name}: {len(transactions)} transactions in "
+                          f"{elapsed * 1000:.0f}ms")
+        return {transaction.id: sorted(
+            (part_id, note, sorted(accounts or []), sorted(categories or []))
+            for part_id, note, accounts, categories in transaction.contents)
+            for transaction in transactions}
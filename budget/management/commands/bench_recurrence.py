@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from typing import Any, Callable
+from datetime import date, timedelta
+from itertools import chain, islice
+import time
+
+from budget.models import (Transaction, Account, Category, fetch_accounts,
+                           check_balances, recurrence)
+from budget.management.synthetic import synthetic_budget
+
+
+class Command(BaseCommand):
+    help = ("Compare copying a daily recurrence that is a year overdue one "
+            "occurrence at a time with copying it in bulk")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--days", type=int, default=365,
+                            help="How overdue the recurrence is")
+
+    def handle(self, *args: Any, days: int, **options: Any):
+        results = {}
+        for name, copy in (('copy_to', self.one_by_one),
+                           ('copy_to_many', Transaction.copy_to_many)):
+            results[name] = self.time(name, copy, days)
+        if results['copy_to'] != results['copy_to_many']:
+            raise CommandError("Results differ")
+
+    @staticmethod
+    def one_by_one(recurring: Transaction, dates: list[date]):
+        for day in dates:
+            recurring.copy_to(day)
+
+    def time(self, name: str,
+             copy: Callable[[Transaction, list[date]], Any], days: int):
+        today = date.today()
+        start = today - timedelta(days=days)
+        with transaction.atomic():
+            budget = synthetic_budget("bench_recurrence", start, today,
+                                      per_month=0)
+            recurring = Transaction.objects.create(
+                date=start, recurrence=recurrence.parse('FREQ=DAILY'))
+            recurring.parts.create(note="Daily").set_entries(
+                budget,
+                {budget.account_set.get(name="Checking"): -100,
+                 budget.get_inbox(Account, 'CHF'): 100},
+                {budget.category_set.get(name="Category 0"): -100,
+                 budget.get_inbox(Category, 'CHF'): 100})
+            [recurring] = Transaction.objects.filter(
+                id=recurring.id).fetch_contents()
+            fetch_accounts([recurring], None)
+            dates = list(islice(recurring.recurrence.iterate(recurring.date),
+                                days))
+
+            started = time.perf_counter()
+            copy(recurring, dates)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{name}: {len(dates)} copies in "
+                              f"{elapsed * 1000:.0f}ms")
+
+            if check_balances():
+                raise CommandError(f"{name} left the balances wrong")
+            result = sorted(
+                (copied.date, part.note, entry.source.name, entry.sink.name,
+                 entry.amount)
+                for copied in (Transaction.objects
+                             .filter(date__lt=start + timedelta(days=days))
+                             .filter(parts__note="Daily")
+                             .prefetch_related('parts__accountentry_set__source',
+                                               'parts__accountentry_set__sink',
+                                               'parts__categoryentry_set__source',
+                                               'parts__categoryentry_set__sink'))
+                for part in copied.parts.all()
+                for entry in chain(part.accountentry_set.all(),
+                                   part.categoryentry_set.all()))
+            transaction.set_rollback(True)
+        return result
@@ -0,0 +1,259 @@
+from django.db import transaction, connection
+from django.db.models import Count
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from django.http import HttpResponse
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from html.parser import HTMLParser
+from typing import Any, Callable, Optional
+from datetime import date
+from urllib.parse import urlencode
+import json
+import statistics
+import time
+
+from budget.models import (Budget, BaseAccount, Account, AccountEntry,
+                           CategoryEntry, Transaction)
+
+
+CASES = ['full', 'account', 'transaction', 'budgeting', 'manage',
+         'quick_add', 'save']
+
+
+class FormData(HTMLParser):
+    """The fields a browser would submit for the forms in a page."""
+
+    def __init__(self):
+        super().__init__()
+        self.data: dict[str, list[str]] = {}
+        self.select: Optional[str] = None
+        self.options: list[str] = []
+        self.selected: list[str] = []
+        self.textarea: Optional[str] = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        attributes = dict(attrs)
+        name = attributes.get('name')
+        if 'disabled' in attributes:
+            return
+        if tag == 'input' and name:
+            kind = attributes.get('type', 'text')
+            if kind in ('checkbox', 'radio') and 'checked' not in attributes:
+                return
+            if kind not in ('submit', 'button', 'reset', 'file'):
+                self.data.setdefault(name, []).append(
+                    attributes.get('value') or '')
+        elif tag == 'select' and name:
+            self.select = name
+            self.options, self.selected = [], []
+        elif tag == 'option' and self.select:
+            value = attributes.get('value') or ''
+            self.options.append(value)
+            if 'selected' in attributes:
+                self.selected.append(value)
+        elif tag == 'textarea' and name:
+            self.textarea = name
+            self.data.setdefault(name, []).append('')
+
+    def handle_data(self, data: str):
+        if self.textarea:
+            self.data[self.textarea][-1] += data
+
+    def handle_endtag(self, tag: str):
+        if tag == 'select' and self.select:
+            self.data[self.select] = self.selected or self.options[:1]
+            self.select = None
+        elif tag == 'textarea':
+            self.textarea = None
+
+
+def form_data(response: HttpResponse):
+    parser = FormData()
+    parser.feed(response.content.decode())
+    return parser.data
+
+
+class Command(BaseCommand):
+    help = ("Time the main views on a budget, and fail if they got slower "
+            "than a saved baseline. Use generate_ledger to make one.")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--budget", required=True,
+                            help="Budget id, or the name of its owner")
+        parser.add_argument("--account", type=int,
+                            help="Account or category id, by default the "
+                            "account with the most entries")
+        parser.add_argument("--transaction", type=int,
+                            help="Transaction id, by default the latest one "
+                            "in the account")
+        parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+        parser.add_argument("--warmup", type=int, default=3)
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--json", metavar="FILE", dest="output",
+                            help="Write the results here")
+        parser.add_argument("--baseline", metavar="FILE",
+                            help="Results of an earlier run to compare with")
+        parser.add_argument("--threshold", type=float, default=0.2,
+                            help="How much slower than the baseline a view's "
+                            "median and 95th percentile may get")
+
+    def handle(self, *args: Any, budget: str, account: Optional[int],
+               transaction: Optional[int], cases: list[str], warmup: int,
+               iterations: int, output: Optional[str], baseline: Optional[str],
+               threshold: float, **options: Any):
+        if iterations < 1:
+            raise CommandError("--iterations must be positive")
+        target = self.find_budget(budget)
+        owner = target.budget_of
+        if not owner:
+            raise CommandError(f"{target} isn't anyone's budget")
+        if account is None:
+            target_account = (Account.objects.filter(budget=target)
+                              .exclude(name='')
+                              .annotate(Count('entries'))
+                              .order_by('-entries__count').first())
+        else:
+            try:
+                target_account = BaseAccount.get(account)
+            except BaseAccount.DoesNotExist:
+                raise CommandError(f"No account {account}")
+        if not target_account:
+            raise CommandError(f"{target} has no accounts")
+        if transaction is None:
+            entries = (AccountEntry if isinstance(target_account, Account)
+                       else CategoryEntry)
+            target_transaction = (Transaction.objects
+                                  .filter(id__in=entries.objects
+                                          .filter(sink=target_account)
+                                          .values('part__transaction'),
+                                          kind=Transaction.Kind.TRANSACTION)
+                                  .order_by('-date', '-id').first())
+            if not target_transaction:
+                raise CommandError(f"{target_account} has no transactions")
+            transaction = target_transaction.id
+
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(owner)
+        requests = self.requests(client, target, target_account.id,
+                                 transaction)
+        self.stdout.write(f"{target} ({target.id}), {target_account} "
+                          f"({target_account.id}), transaction {transaction}, "
+                          f"{connection.vendor}")
+
+        results: dict[str, dict[str, float]] = {}
+        for case in cases:
+            results[case] = self.measure(requests[case], warmup, iterations)
+            self.stdout.write(
+                f"{case}: p50 {results[case]['p50']:.1f}ms, "
+                f"p95 {results[case]['p95']:.1f}ms, "
+                f"p99 {results[case]['p99']:.1f}ms, "
+                f"{results[case]['queries']:.0f} queries")
+
+        if output:
+            with open(output, 'w', encoding='utf-8') as file:
+                dump = {'budget': target.id, 'account': target_account.id,
+                        'transaction': transaction, 'iterations': iterations,
+                        'database': connection.vendor, 'results': results}
+                file.write(json.dumps(dump, indent=2))
+        if baseline:
+            self.compare(baseline, results, threshold)
+
+    @staticmethod
+    def find_budget(selector: str) -> Budget:
+        budget = (Budget.objects.filter(id=int(selector)) if selector.isdigit()
+                  else Budget.objects.filter(budget_of__username=selector)).first()
+        if not budget:
+            raise CommandError(f"No budget {selector}")
+        return budget
+
+    def requests(self, client: Client, budget: Budget, account_id: int,
+                 transaction_id: int) -> dict[str, Callable[[], HttpResponse]]:
+        """Make the request of each case."""
+        account_url = reverse('all', args=(budget.id, account_id))
+        transaction_url = reverse('all', args=(budget.id, account_id,
+                                               transaction_id))
+        today = date.today()
+
+        def quick_add():
+            data = {'qa-date': today.isoformat(), 'qa-note': "Benchmark",
+                    'qa-amount': 100}
+            return client.put(account_url, urlencode(data),
+                              content_type='application/x-www-form-urlencoded',
+                              headers={'HX-Target': 'account'})
+
+        saved: dict[str, list[str]] = {}
+
+        def save():
+            # Submit the transaction form unchanged, like a browser would
+            if not saved:
+                saved.update(form_data(client.get(
+                    transaction_url, headers={'HX-Target': 'transaction'})))
+            return client.post(transaction_url, saved,
+                               headers={'HX-Target': 'transaction'})
+
+        return {
+            'full': lambda: client.get(account_url),
+            'account': lambda: client.get(account_url,
+                                          headers={'HX-Target': 'account'}),
+            'transaction': lambda: client.get(
+                transaction_url, headers={'HX-Target': 'transaction'}),
+            'budgeting': lambda: client.get(reverse(
+                'budget', args=(budget.id, today.year, today.month))),
+            'manage': lambda: client.get(reverse('manage', args=(budget.id,))),
+            'quick_add': quick_add,
+            'save': save,
+        }
+
+    def measure(self, request: Callable[[], HttpResponse],
+                warmup: int, iterations: int) -> dict[str, float]:
+        """Run a request repeatedly, and undo what it changed."""
+        with transaction.atomic():
+            for _ in range(warmup):
+                self.check_response(request())
+            times: list[float] = []
+            queries: list[int] = []
+            for _ in range(iterations):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = request()
+                    times.append((time.perf_counter() - start) * 1000)
+                self.check_response(response)
+                queries.append(len(captured))
+            transaction.set_rollback(True)
+        cuts = (statistics.quantiles(times, n=100, method='inclusive')
+                if len(times) > 1 else times * 99)
+        return {'p50': cuts[49], 'p95': cuts[94], 'p99': cuts[98],
+                'queries': statistics.mean(queries)}
+
+    @staticmethod
+    def check_response(response: HttpResponse):
+        if response.status_code >= 400:
+            raise CommandError(f"{response.status_code} from "
+                               f"{response.request['PATH_INFO']}")
+
+    def compare(self, filename: str, results: dict[str, dict[str, float]],
+                threshold: float):
+        try:
+            with open(filename, encoding='utf-8') as file:
+                baseline: dict[str, dict[str, float]] = json.load(file)['results']
+        except (OSError, ValueError, KeyError) as error:
+            raise CommandError(f"Can't read the baseline {filename}: {error}")
+        regressions: list[str] = []
+        for case, result in results.items():
+            if case not in baseline:
+                continue
+            for metric in ('p50', 'p95'):
+                if result[metric] > baseline[case][metric] * (1 + threshold):
+                    regressions.append(
+                        f"{case} {metric} {result[metric]:.1f}ms, "
+                        f"was {baseline[case][metric]:.1f}ms")
+            if result['queries'] > baseline[case]['queries']:
+                regressions.append(
+                    f"{case} {result['queries']:.0f} queries, "
+                    f"was {baseline[case]['queries']:.0f}")
+        if regressions:
+            raise CommandError("Slower than the baseline: "
+                               + "; ".join(regressions))
+        self.stdout.write(f"No regressions against {filename}")
+
@@ -0,0 +1,55 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from typing import Any
+from datetime import date
+import time
+
+from budget.models import (User, Transaction, TransactionPart, AccountEntry,
+                           CategoryEntry)
+from budget.management.synthetic import synthetic_ledger, CURRENCIES
+
+
+class Command(BaseCommand):
+    help = ("Fill the database with a synthetic ledger for several users, "
+            "for benchmarks")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--users", type=int, default=10)
+        parser.add_argument("--years", type=int, default=5)
+        parser.add_argument("--end", type=date.fromisoformat,
+                            default=date(2024, 1, 1),
+                            help="Date the ledger runs up to, so that it "
+                            "doesn't depend on when it's made")
+        parser.add_argument("--per-month", type=int, default=100,
+                            help="Spending transactions per user and month")
+        parser.add_argument("--currencies", type=int, default=2,
+                            choices=range(1, len(CURRENCIES) + 1))
+        parser.add_argument("--categories", type=int, default=10,
+                            help="Categories per user and currency")
+        parser.add_argument("--payees", type=int, default=10,
+                            help="Payees per user")
+        parser.add_argument("--friends", type=int, default=2,
+                            help="Friends per user, on average")
+        parser.add_argument("--prefix", default="user",
+                            help="Start of the user names")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args: Any, users: int, years: int, end: date,
+               per_month: int, currencies: int, categories: int, payees: int,
+               friends: int, prefix: str, seed: int, **options: Any):
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(f"There are already users named {prefix}...")
+        start = end.replace(year=end.year - years)
+        counts = {model: model.objects.count()
+                  for model in (Transaction, TransactionPart,
+                                AccountEntry, CategoryEntry)}
+        started = time.perf_counter()
+        with transaction.atomic():
+            synthetic_ledger(users, start, end, prefix=prefix,
+                             currencies=currencies, categories=categories,
+                             payees=payees, friends=friends,
+                             per_month=per_month, seed=seed)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(", ".join(
+            f"{model.objects.count() - count} {model._meta.verbose_name_plural}"
+            for model, count in counts.items()) + f" in {elapsed:.1f}s")
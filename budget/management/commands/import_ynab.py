@@ -1,21 +1,34 @@
-from django.db import transaction
+import django
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models import Q, F, Min, Max, Sum
 from django.db.models.functions import Trunc
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandParser, CommandError
 from budget.models import (User, Budget, Account, Category, Transaction, TransactionPart,
-                           BaseAccount, AccountT, CategoryEntry, months_between)
-
-from typing import Any, Iterable, TypeVar, Callable
-from collections import defaultdict
+                           BaseAccount, AccountT, CategoryEntry, months_between,
+                           BudgetFriends, ImportCheckpoint, ImportFingerprint,
+                           set_entries_many, record_entries, record_entries_of,
+                           roll_balances, roll_balances_of, entry_changes)
+
+from typing import Any, Iterable, Iterator, TypeVar, Callable, Optional
+from collections import defaultdict, deque, Counter
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import nullcontext, redirect_stdout
 from datetime import datetime, date, timedelta
 import csv
 import re
 import copy
 from glob import glob
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields
+from itertools import chain, count, repeat
 import functools
+import hashlib
+import io
+import json
+import os
+import time
 
 ynab_transfer_prefix = "Transfer : "
 ynab_debt_payments_prefix = "Debt Payments:  "
@@ -75,7 +88,8 @@ class RawBudgetEventRecord:
         return RawBudgetEventRecord(*row)
 
 
-@dataclass(eq=True, frozen=True)
+# Compared by identity, so each import gets its own caches
+@dataclass(eq=False, frozen=True)
 class TargetBudget:
     budget: Budget
 
@@ -85,6 +99,10 @@ class TargetBudget:
         return Budget.objects.get_or_create(
             name=name, payee_of=self.budget.budget_of)[0]
 
+    @functools.cache
+    def inbox(self, payee: str, cls: type[AccountT]) -> AccountT:
+        return self.payee(payee).get_inbox(cls, currency=ynab_currency)
+
     @functools.cache
     def account(self, name: str, currency: str):
         assert name
@@ -99,41 +117,252 @@ class TargetBudget:
             defaults={'group': group, 'order': 999})[0]
 
 
+# Compared by identity, so each import gets its own caches
+@dataclass(eq=False, frozen=True)
+class DryRunBudget(TargetBudget):
+    """Makes unsaved objects instead of looking them up, and counts them."""
+    created: 'Counter[str]' = field(default_factory=Counter)
+    ids: Iterator[int] = field(default_factory=lambda: count(1))
+
+    @functools.cache
+    def payee(self, name: str):
+        assert name
+        self.created['payees'] += 1
+        return Budget(pk=next(self.ids), name=name)
+
+    @functools.cache
+    def inbox(self, payee: str, cls: type[AccountT]) -> AccountT:
+        return cls(pk=next(self.ids), budget=self.payee(payee),
+                   currency=ynab_currency)
+
+    @functools.cache
+    def account(self, name: str, currency: str):
+        assert name
+        self.created['accounts'] += 1
+        return Account(pk=next(self.ids), budget=self.budget, name=name,
+                       currency=currency)
+
+    @functools.cache
+    def category(self, name: str, group: str, currency: str):
+        assert name
+        self.created['categories'] += 1
+        return Category(pk=next(self.ids), budget=self.budget, name=name,
+                        currency=currency, group=group, order=999)
+
+
 ynab_currency = "CHF"
 
 T = TypeVar('T')
 TransferKey = tuple[str, str, int]
+# A transaction waiting to be written, with its fingerprint and the note and
+# entries of each part
+PendingTransaction = tuple[Transaction, str,
+                           list[tuple[str, dict[Account, int], dict[Category, int]]]]
+# The rows of a day, and the rows of each transaction if they were matched up
+MatchedDay = tuple[list[RawTransactionPartRecord],
+                   Optional[list[list[RawTransactionPartRecord]]]]
+# The fingerprints imported on each day, of each kind of transaction
+FingerprintIndex = dict[tuple[str, date], dict[str, int]]
 
 
 class Command(BaseCommand):
     help = "Import a YNAB budget"
+    bulk = False
+    batch_size = 1000
+    chunk_days: Optional[int] = None
+    workers = 0
+    rows_per_task = 2000
 
     def add_arguments(self, parser: CommandParser) -> None:
-        parser.add_argument("directory", nargs=1, type=str)
-
-    @transaction.atomic
-    def handle(self, *args: Any, directory: str, **options: Any):
-        filenames = glob(f"{directory[0]}/*Register.csv")
+        parser.add_argument("directory", nargs="?", type=str)
+        parser.add_argument("--user", default="chloe",
+                            help="The user whose budget to import into")
+        parser.add_argument("--manifest", metavar="FILE",
+                            help="A JSON object from user names to the "
+                            "directories to import for them, instead of "
+                            "--user and a directory")
+        parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                            metavar="N",
+                            help="With --manifest, import for up to N users "
+                            "at once")
+        parser.add_argument("--bulk", action="store_true",
+                            help="Buffer transactions and write them in batches")
+        parser.add_argument("--chunk-days", type=int, metavar="N",
+                            help="Commit every N days of the register and "
+                            "every month of the budget, and resume from the "
+                            "last commit when rerun")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Check the export and count what it "
+                            "contains, without using the database")
+        parser.add_argument("--workers", type=int, default=0, metavar="N",
+                            help="Parse and match up the register in N "
+                            "processes while this one writes it")
+
+    def handle(self, *args: Any, directory: Optional[str], user: str = "chloe",
+               manifest: Optional[str] = None, jobs: int = 1,
+               bulk: bool = False, chunk_days: Optional[int] = None,
+               workers: int = 0, dry_run: bool = False, **options: Any):
+        if chunk_days is not None and chunk_days < 1:
+            raise CommandError("--chunk-days must be positive")
+        if workers < 0:
+            raise CommandError("--workers can't be negative")
+        if manifest:
+            if directory:
+                raise CommandError("Give either a directory or --manifest")
+            self.import_manifest(manifest, jobs, {
+                'bulk': bulk, 'chunk_days': chunk_days, 'workers': workers,
+                'dry_run': dry_run})
+            return
+        if not directory:
+            raise CommandError("No directory or --manifest given")
+        self.bulk = bulk
+        self.chunk_days = chunk_days
+        self.workers = workers
+        self.pending: list[PendingTransaction] = []
+        filenames = glob(f"{directory}/*Register.csv")
         if len(filenames) == 1:
             register_filename = filenames[0]
         else:
-            raise CommandError(f"No single register file in {directory[0]}")
-        filenames = glob(f"{directory[0]}/*Budget.csv")
+            raise CommandError(f"No single register file in {directory}")
+        filenames = glob(f"{directory}/*Budget.csv")
         if len(filenames) == 1:
             budget_filename = filenames[0]
         else:
-            raise CommandError(f"No single budget file in {directory[0]}")
+            raise CommandError(f"No single budget file in {directory}")
 
-        user = User.objects.get(username="chloe")
-        target_budget = TargetBudget(Budget.objects.get_or_create(
-            name="Chloe", budget_of=user)[0])
-
-        self.process_transactions(
-            target_budget, Command.csv_rows(register_filename, RawTransactionPartRecord.from_row))
+        if dry_run:
+            self.dry_run(register_filename, budget_filename, user)
+            return
 
-        self.process_budget_events(
-            target_budget, Command.csv_rows(budget_filename, RawBudgetEventRecord.from_row))
+        try:
+            owner = User.objects.get(username=user)
+        except User.DoesNotExist:
+            raise CommandError(f"No user {user}")
+        target_budget = TargetBudget(Budget.objects.get_or_create(
+            name=user.capitalize(), budget_of=owner)[0])
+        self.known = self.fingerprints(target_budget)
+        self.counts: Counter[str] = Counter()
+
+        # Without chunks, the whole import is one transaction
+        with nullcontext() if chunk_days else transaction.atomic():
+            self.process_transactions(
+                target_budget, self.matched_days(register_filename))
+
+            self.process_budget_events(
+                target_budget, Command.csv_rows(budget_filename, RawBudgetEventRecord.from_row))
+
+            with transaction.atomic():
+                # Days that are no longer in the export
+                self.delete_stale(chain.from_iterable(
+                    day.values() for day in self.known.values()))
+                self.finish(target_budget)
+                ImportCheckpoint.objects.filter(
+                    budget=target_budget.budget).delete()
+        print(f"{self.counts['new']} new, {self.counts['unchanged']} unchanged, "
+              f"{self.counts['stale']} removed transactions")
+
+    def import_manifest(self, filename: str, jobs: int, options: dict[str, Any]):
+        """Import for each user in the manifest. Users whose budgets are
+        friends are imported one after another, and the others in parallel."""
+        try:
+            with open(filename, encoding='utf-8') as file:
+                imports: dict[str, str] = json.load(file)
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Can't read {filename}: {error}")
+        if (not isinstance(imports, dict)
+                or not all(isinstance(directory, str)
+                           for directory in imports.values())):
+            raise CommandError(
+                f"{filename} should map user names to directories")
+        groups = [[(user, imports[user]) for user in group]
+                  for group in friend_groups(list(imports))]
+
+        started = time.perf_counter()
+        failed = 0
+        parallel = jobs > 1 and len(groups) > 1
+        if (parallel and not options['dry_run']
+                and connections[DEFAULT_DB_ALIAS].vendor == 'sqlite'):
+            print("SQLite only allows one writer, importing one user at a time")
+            parallel = False
+        if parallel:
+            # Don't share the connections with the worker processes
+            connections.close_all()
+        with (ProcessPoolExecutor(min(jobs, len(groups)), initializer=django.setup)
+              if parallel else nullcontext()) as pool:
+            if pool:
+                results: Iterable[list[tuple[str, float, str]]] = (
+                    task.result() for task in as_completed(
+                        [pool.submit(import_group, group, options)
+                         for group in groups]))
+            else:
+                results = map(import_group, groups, repeat(options))
+            for result in results:
+                for user, seconds, summary in result:
+                    failed += summary.startswith("Failed")
+                    print(f"{user}: {summary} in {seconds:.2f}s")
+        print(f"{len(imports)} users in {time.perf_counter() - started:.2f}s")
+        if failed:
+            raise CommandError(f"Imports that failed: {failed}")
+
+    def dry_run(self, register_filename: str, budget_filename: str, user: str):
+        """Match up the export and convert it to entries in memory, and report
+        the rows that don't work."""
+        started = time.perf_counter()
+        target_budget = DryRunBudget(Budget(name=user.capitalize()))
+        problems: list[str] = []
+        for day_transaction_parts, matched in self.matched_days(register_filename):
+            if matched is None:
+                try:
+                    matched = match_day(day_transaction_parts)
+                except (AssertionError, IndexError) as error:
+                    problems.append(f"{day_transaction_parts[0].Date}: "
+                                    f"Unmatched transfers {error}")
+                    continue
+            for raw_transaction_parts in matched:
+                target_budget.created['transactions'] += 1
+                for raw_parts in group_parts(raw_transaction_parts).values():
+                    target_budget.created['parts'] += 1
+                    try:
+                        parts_to_entries(raw_parts, target_budget)
+                    except AssertionError:
+                        problems.append(f"{raw_parts[0]}: Doesn't add up to zero")
+        months, _ = budget_months(target_budget, Command.csv_rows(
+            budget_filename, RawBudgetEventRecord.from_row))
+        target_budget.created['budget months'] += len(months)
+
+        for problem in problems:
+            print(problem)
+        print(", ".join(f"{number} {name}" for name, number
+                        in sorted(target_budget.created.items())),
+              f"in {time.perf_counter() - started:.2f}s")
+        if problems:
+            raise CommandError(f"Problems in the export: {len(problems)}")
 
+    @staticmethod
+    def fingerprints(target_budget: TargetBudget) -> FingerprintIndex:
+        """Index the transactions imported before by date and fingerprint."""
+        known: FingerprintIndex = defaultdict(dict)
+        for kind, day, fingerprint, transaction_id in (
+                ImportFingerprint.objects
+                .filter(budget=target_budget.budget)
+                .values_list('transaction__kind', 'date', 'fingerprint',
+                             'transaction')):
+            known[(kind, day)][fingerprint] = transaction_id
+        return known
+
+    def delete_stale(self, transaction_ids: Iterable[int]):
+        """Delete imported transactions whose rows are gone from the export."""
+        ids = list(transaction_ids)
+        if not ids:
+            return
+        roll_balances_of(part__transaction__in=ids)
+        record_entries_of(-1, part__transaction__in=ids)
+        Transaction.objects.filter(id__in=ids).delete()
+        self.counts['stale'] += len(ids)
+
+    def finish(self, target_budget: TargetBudget):
+        """Tidy up the imported accounts and categories."""
+        user = target_budget.budget.budget_of
         splitwise_account = target_budget.account("Flat splitwise", "CHF")
         splitwise_account_category = target_budget.category(
             "🌐 Flat splitwise", "", "CHF")
@@ -158,112 +387,130 @@ class Command(BaseCommand):
             for row in reader:
                 yield from_row(row)
 
-    def process_transactions(self, target_budget: TargetBudget, reader: 'Iterable[RawTransactionPartRecord]'):
-        current_date = None
+    @staticmethod
+    def days(reader: 'Iterable[RawTransactionPartRecord]'
+             ) -> 'Iterable[list[RawTransactionPartRecord]]':
+        """Group consecutive register rows with the same date."""
         day_transaction_parts: list[RawTransactionPartRecord] = []
-
         for raw_transaction_part in reader:
             # FIXME
             # process_transaction_renames(raw_transaction_part)
+            if (day_transaction_parts
+                    and raw_transaction_part.Date != day_transaction_parts[0].Date):
+                yield day_transaction_parts
+                day_transaction_parts = []
+            day_transaction_parts.append(raw_transaction_part)
+        if day_transaction_parts:
+            yield day_transaction_parts
+
+    def matched_days(self, filename: str) -> Iterable[MatchedDay]:
+        """The days of the register. With workers, they are parsed and matched
+        up in other processes, a few tasks ahead of the caller."""
+        if not self.workers:
+            for day_transaction_parts in self.days(Command.csv_rows(
+                    filename, RawTransactionPartRecord.from_row)):
+                yield day_transaction_parts, None
+            return
+        with ProcessPoolExecutor(self.workers, initializer=django.setup) as pool:
+            tasks: deque[Future[list[MatchedDay]]] = deque()
+            for rows in Command.csv_day_chunks(filename, self.rows_per_task):
+                tasks.append(pool.submit(match_rows, rows))
+                if len(tasks) > 2 * self.workers:
+                    yield from tasks.popleft().result()
+            while tasks:
+                yield from tasks.popleft().result()
 
-            if not current_date:
-                current_date = raw_transaction_part.Date
-                day_transaction_parts.append(raw_transaction_part)
+    @staticmethod
+    def csv_day_chunks(filename: str, size: int) -> Iterable[list[list[str]]]:
+        """Split the rows of the register into chunks of whole days with at
+        least 'size' rows each."""
+        date_column = [field.name for field
+                       in fields(RawTransactionPartRecord)].index('Date')
+        chunk: list[list[str]] = []
+        for row in Command.csv_rows(filename, lambda row: row):
+            if len(chunk) >= size and row[date_column] != chunk[-1][date_column]:
+                yield chunk
+                chunk = []
+            chunk.append(row)
+        if chunk:
+            yield chunk
+
+    def process_transactions(self, target_budget: TargetBudget, days: Iterable[MatchedDay]):
+        started = time.perf_counter()
+        rows = 0
+        checkpoint = self.checkpoint(target_budget)
+        if checkpoint and checkpoint.register_date:
+            # Skip through the day that was imported last, which might not be
+            # in this export anymore, and put back the first day after it
+            days = iter(days)
+            for matched_day in days:
+                day = YNAB_string_to_date(matched_day[0][0].Date)
+                if day > checkpoint.register_date:
+                    days = chain([matched_day], days)
+                    break
+                rows += len(matched_day[0])
+                self.known.pop((Transaction.Kind.TRANSACTION, day), None)
+            print(f"Resuming after {checkpoint.register_date}, {rows} rows")
+
+        def progress(current_date: str):
+            if not self.bulk:
                 print(current_date)
-            else:
-                if raw_transaction_part.Date == current_date:
-                    day_transaction_parts.append(raw_transaction_part)
-                else:
-                    self.process_day(target_budget, day_transaction_parts)
-
-                    day_transaction_parts.clear()
-                    current_date = raw_transaction_part.Date
-                    if current_date.startswith("01"):
-                        print(current_date)
-                    day_transaction_parts.append(raw_transaction_part)
-        self.process_day(target_budget, day_transaction_parts)
+                return
+            elapsed = time.perf_counter() - started
+            print(f"{current_date}: {rows} rows, "
+                  f"{rows / elapsed if elapsed else 0:.0f} rows/s")
+
+        for chunk in self.chunks(days):
+            with transaction.atomic():
+                for day_transaction_parts, matched in chunk:
+                    current_date = day_transaction_parts[0].Date
+                    if not rows or current_date.startswith("01"):
+                        progress(current_date)
+                    rows += len(day_transaction_parts)
+                    self.process_day(target_budget, day_transaction_parts,
+                                     matched)
+                self.flush(target_budget)
+                if checkpoint:
+                    checkpoint.register_date = YNAB_string_to_date(current_date)
+                    checkpoint.save()
+
+    def chunks(self, days: Iterable[MatchedDay]):
+        """Split the days into chunks to be committed separately."""
+        if not self.chunk_days:
+            yield days
+            return
+        chunk: list[MatchedDay] = []
+        for day in days:
+            chunk.append(day)
+            if len(chunk) == self.chunk_days:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def checkpoint(self, target_budget: TargetBudget):
+        """The progress of a chunked import, or None if it isn't chunked."""
+        if not self.chunk_days:
+            return None
+        return ImportCheckpoint.objects.get_or_create(
+            budget=target_budget.budget)[0]
 
     def process_day(self, target_budget: TargetBudget,
-                    day_transaction_parts: list[RawTransactionPartRecord]):
-        unmatched_transfers: dict[TransferKey, list[int]] = defaultdict(list)
-
-        for ix, part in enumerate(day_transaction_parts):
-            if is_split(part):
-                pass
-            elif is_transfer(part):
-                transfer_key = get_transfer_key(part)
-                if transfer_key in unmatched_transfers:  # Non-split transfer
-                    other_part_ix = unmatched_transfers[transfer_key].pop()
-                    other_part = day_transaction_parts[other_part_ix]
-                    determine_off_budget(part, other_part)
-                    self.save_transaction(target_budget, [part, other_part])
-                else:  # Some other kind of transfer
-                    unmatched_transfers[expected_transfer_key(part)].append(ix)
-            else:   # Non-split non-transfer
-                self.save_transaction(target_budget, [part])
-        # unmatched_transfers now contains the non-split sides of all the splits with transfers
-
-        # For no apparent reason, split transactions are represented differently depending on whether
-        # the main payee is a transfer ("split transfer"). If not, each part of the split has its own
-        # entry for both accounts and the main memo is dropped. If so, there is only one entry for
-        # the other account with everything lumped together, and the main memo is on that entry.
-
-        # Regular split with transfer -------------------------------------------------------------
-        # ZKB Current Acct   Holy Cow                      Quality of Life  c        Split (1/3)  x
-        # ZKB Current Acct   Transfer: Dan Tracking        Category 1       a        Split (2/3)  y
-        # ZKB Current Acct   Transfer: Dan Tracking        Category 2       b        Split (3/3)  z
-        # Dan Tracking       Transfer: ZKB Current Acct         -           -a       y
-        # Dan Tracking       Transfer: ZKB Current Acct         -           -b       z
-
-        # Split transfer --------------------------------------------------------------------------
-        # ZKB Current Acct   Transfer: UZH Reimbursement   Halbtax          a        Split (1/2)  y
-        # ZKB Current Acct   Transfer: UZH Reimbursement   Reimbursements   b        Split (2/2)  z
-        # UZH Reimbursement  Transfer: ZKB Current Acct         -           - a - b  main
-
-        current_split: list[RawTransactionPartRecord] = []
-        other_sides: list[RawTransactionPartRecord] = []
-        current_split_transfers: dict[tuple[str, str], int] = defaultdict(
-            int)  # (to, from) => amount
-        for ix, part in enumerate(day_transaction_parts):
-            if not is_split(part):
-                assert not current_split
-                assert not other_sides
-                assert not current_split_transfers
-                continue
-            current_split.append(part)
-            if is_transfer(part):
-                transfer_key = get_transfer_key(part)
-                if transfer_key in unmatched_transfers:
-                    other_part_ix = unmatched_transfers[transfer_key].pop()
-                    other_part = day_transaction_parts[other_part_ix]
-                    determine_off_budget(part, other_part)
-                    current_split.append(other_part)
-                else:  # This is part of a split transfer
-                    from_acc, to_acc, amount = transfer_key
-                    current_split_transfers[(from_acc, to_acc)] += amount
-                    # Make a fake one so that the notes match.
-                    other_part = copy.copy(part)
-                    other_part.CategoryGroupCategory = ''  # Is this right?
-                    other_part.Account = to_acc
-                    other_part.Inflow, other_part.Outflow = part.Outflow, part.Inflow
-                    determine_off_budget(part, other_part)
-                    current_split.append(other_part)
-            if is_last_part_in_split(part):
-                # We have all the totals of split transfers, so we should be able to match them
-                for (from_acc, to_acc), amount in current_split_transfers.items():
-                    transfer_key = (from_acc, to_acc, amount)
-                    other_part_ix = unmatched_transfers[transfer_key].pop()
-                    # We add a fake part instead.
-                    # other_part = day_transaction_parts[other_part_ix]
-                    # current_split.append(other_part)
-                current_split_transfers.clear()
-                self.save_transaction(target_budget, current_split)  # DOING
-                current_split = []
-                other_sides = []
-        assert not current_split
-        assert not current_split_transfers
-        assert not other_sides
-        assert not any(unmatched_transfers.values()), unmatched_transfers
+                    day_transaction_parts: list[RawTransactionPartRecord],
+                    matched: 'Optional[list[list[RawTransactionPartRecord]]]' = None):
+        """Write the transactions of one day, given the rows of each one if
+        they were already matched up."""
+        # The transactions imported on this day before, which are deleted if
+        # they aren't found again
+        self.today = self.known.pop(
+            (Transaction.Kind.TRANSACTION,
+             YNAB_string_to_date(day_transaction_parts[0].Date)), {})
+        self.occurrences: Counter[tuple[str, ...]] = Counter()
+        if matched is None:
+            matched = match_day(day_transaction_parts)
+        for raw_transaction_parts in matched:
+            self.save_transaction(target_budget, raw_transaction_parts)
+        self.delete_stale(self.today.values())
 
     def save_transaction(self, target_budget: TargetBudget,
                          raw_transaction_parts: 'list[RawTransactionPartRecord]'):
@@ -271,21 +518,33 @@ class Command(BaseCommand):
         date = YNAB_string_to_date(
             first_raw_transaction_part.Date)  # filter for past dates
 
+        # Identical transactions on the same day are told apart by their order
+        keys = tuple(sorted(row_key(raw_part)
+                     for raw_part in raw_transaction_parts))
+        self.occurrences[keys] += 1
+        fingerprint = make_fingerprint(keys, self.occurrences[keys])
+        if self.today.pop(fingerprint, None):
+            self.counts['unchanged'] += 1
+            return
+        self.counts['new'] += 1
+
         kind = Transaction.Kind.TRANSACTION
         transaction = Transaction(date=date, kind=kind)
-        transaction.save()
+        if not self.bulk:
+            transaction.save()
+            ImportFingerprint.objects.create(
+                budget=target_budget.budget, fingerprint=fingerprint,
+                date=date, transaction=transaction)
 
-        grouped_parts: dict[str, list[RawTransactionPartRecord]] = {}
-        for raw_part in raw_transaction_parts:
-            grouped_parts.setdefault(
-                cleaned_memo(raw_part), []).append(raw_part)
+        grouped_parts = group_parts(raw_transaction_parts)
 
-        # Merge parts if there's only one actual memo
-        if len(grouped_parts) == 2:
-            one, other = grouped_parts
-            if not one or not other:
-                grouped_parts = {
-                    one or other: grouped_parts[one] + grouped_parts[other]}
+        if self.bulk:
+            self.pending.append((transaction, fingerprint, [
+                (memo, *parts_to_entries(raw_parts, target_budget))
+                for memo, raw_parts in grouped_parts.items()]))
+            if len(self.pending) >= self.batch_size:
+                self.flush(target_budget)
+            return
 
         for memo, raw_parts in grouped_parts.items():
             transaction_part = TransactionPart(
@@ -297,60 +556,271 @@ class Command(BaseCommand):
             transaction_part.set_entries(
                 target_budget.budget, account_entries, category_entries)
 
+    def flush(self, target_budget: TargetBudget):
+        """Write the transactions buffered in bulk mode."""
+        if not self.pending:
+            return
+        transactions = Transaction.objects.bulk_create(
+            [transaction for transaction, _, _ in self.pending])
+        ImportFingerprint.objects.bulk_create(
+            [ImportFingerprint(budget=target_budget.budget,
+                               fingerprint=fingerprint,
+                               date=transaction.date, transaction=transaction)
+             for transaction, fingerprint, _ in self.pending])
+        contents = list(chain(*(parts for _, _, parts in self.pending)))
+        parts = TransactionPart.objects.bulk_create(
+            [TransactionPart(transaction=transaction, note=memo)
+             for transaction, (_, _, transaction_parts) in zip(transactions, self.pending)
+             for memo, _, _ in transaction_parts])
+        set_entries_many(target_budget.budget,
+                         [(part, accounts, categories)
+                          for part, (_, accounts, categories) in zip(parts, contents)])
+        self.pending.clear()
+
     def process_budget_events(self, target_budget: TargetBudget,
                               reader: 'Iterable[RawBudgetEventRecord]'):
-        raw_category_group_category = "Inflow: Ready to Assign"
-        raw_category, raw_group = split_category_group_category(
-            raw_category_group_category)
-        inflow_budget_category = target_budget.category(
-            raw_category, raw_group, ynab_currency)
         kind = Transaction.Kind.BUDGETING
+        month_budgets, final_categories = budget_months(target_budget, reader)
+        checkpoint = self.checkpoint(target_budget)
 
-        month_budgets: dict[date, dict[Category, RawBudgetEventRecord]] = defaultdict(
-            dict)  # month -> cat -> budgeted_amount
-
-        # parse csv
-        for raw_budget_event in reader:
-            # FIXME
-            # process_budget_renames(raw_budget_event)
-
-            # FIXME: Is this correct?
-            if raw_budget_event.CategoryGroup == "Credit Card Payments":
-                continue  # TODO this works for me as I have no credit card debt
-            month = datetime.strptime(raw_budget_event.Month, "%b %Y").date()
-            raw_category_group_category = raw_budget_event.CategoryGroupCategory
-            raw_category, raw_group = split_category_group_category(
-                raw_category_group_category)
-            category = target_budget.category(
-                raw_category, raw_group, ynab_currency)
-            month_budgets[month][category] = raw_budget_event
-
-        final_month = list(month_budgets)[-1]
-
-        for month, events in month_budgets.items():
-            if month == final_month:
-                # You can be overspend in the current month
-                categories = {category: events[category].Assigned()
-                              for category in events}
-            else:
-                categories = {category: events[category].TotalBudgeted()
-                              for category in events}
-
-            categories[inflow_budget_category] = -sum(categories.values())
-
-            transaction = Transaction(date=month, kind=kind)
-            transaction.save()
-            part = TransactionPart(transaction=transaction)
-            part.save()
-            part.set_entries(target_budget.budget,
-                             accounts={}, categories=categories)
+        for month, categories in month_budgets.items():
+            known = self.known.pop((kind, month), {})
+            if (checkpoint and checkpoint.budget_month
+                    and month <= checkpoint.budget_month):
+                continue
+            fingerprint = make_fingerprint(
+                (str(month), *sorted(f"{category.pk}|{amount}"
+                                     for category, amount in categories.items())), 1)
+
+            with transaction.atomic():
+                unchanged = known.pop(fingerprint, None)
+                self.delete_stale(known.values())
+                if unchanged:
+                    self.counts['unchanged'] += 1
+                else:
+                    self.counts['new'] += 1
+                    budgeting = Transaction(date=month, kind=kind)
+                    budgeting.save()
+                    ImportFingerprint.objects.create(
+                        budget=target_budget.budget, fingerprint=fingerprint,
+                        date=month, transaction=budgeting)
+                    part = TransactionPart(transaction=budgeting)
+                    part.save()
+                    part.set_entries(target_budget.budget,
+                                     accounts={}, categories=categories)
+                if checkpoint:
+                    checkpoint.budget_month = month
+                    checkpoint.save()
 
         # This mixes them with the current ordering lol.
-        for order, category in enumerate(month_budgets[final_month]):
+        for order, category in enumerate(final_categories):
             category.order = order
             category.save()
 
 
+def budget_months(target_budget: TargetBudget,
+                  reader: 'Iterable[RawBudgetEventRecord]'):
+    """The amount budgeted in each category in each month, and the categories
+    of the last month in order."""
+    raw_category_group_category = "Inflow: Ready to Assign"
+    raw_category, raw_group = split_category_group_category(
+        raw_category_group_category)
+    inflow_budget_category = target_budget.category(
+        raw_category, raw_group, ynab_currency)
+
+    month_budgets: dict[date, dict[Category, RawBudgetEventRecord]] = defaultdict(
+        dict)  # month -> cat -> budgeted_amount
+
+    # parse csv
+    for raw_budget_event in reader:
+        # FIXME
+        # process_budget_renames(raw_budget_event)
+
+        # FIXME: Is this correct?
+        if raw_budget_event.CategoryGroup == "Credit Card Payments":
+            continue  # TODO this works for me as I have no credit card debt
+        month = datetime.strptime(raw_budget_event.Month, "%b %Y").date()
+        raw_category_group_category = raw_budget_event.CategoryGroupCategory
+        raw_category, raw_group = split_category_group_category(
+            raw_category_group_category)
+        category = target_budget.category(
+            raw_category, raw_group, ynab_currency)
+        month_budgets[month][category] = raw_budget_event
+
+    final_month = list(month_budgets)[-1]
+    amounts: dict[date, dict[Category, int]] = {}
+    for month, events in month_budgets.items():
+        if month == final_month:
+            # You can be overspend in the current month
+            categories = {category: events[category].Assigned()
+                          for category in events}
+        else:
+            categories = {category: events[category].TotalBudgeted()
+                          for category in events}
+
+        categories[inflow_budget_category] = -sum(categories.values())
+        amounts[month] = categories
+    return amounts, list(month_budgets[final_month])
+
+
+def match_day(day_transaction_parts: 'list[RawTransactionPartRecord]'
+              ) -> 'list[list[RawTransactionPartRecord]]':
+    """Group the rows of one day into transactions, matching up the two sides
+    of transfers. This doesn't touch the database, so it can run in a worker."""
+    unmatched_transfers: dict[TransferKey, list[int]] = defaultdict(list)
+    matched: list[list[RawTransactionPartRecord]] = []
+
+    for ix, part in enumerate(day_transaction_parts):
+        if is_split(part):
+            pass
+        elif is_transfer(part):
+            transfer_key = get_transfer_key(part)
+            if transfer_key in unmatched_transfers:  # Non-split transfer
+                other_part_ix = unmatched_transfers[transfer_key].pop()
+                other_part = day_transaction_parts[other_part_ix]
+                determine_off_budget(part, other_part)
+                matched.append([part, other_part])
+            else:  # Some other kind of transfer
+                unmatched_transfers[expected_transfer_key(part)].append(ix)
+        else:   # Non-split non-transfer
+            matched.append([part])
+    # unmatched_transfers now contains the non-split sides of all the splits with transfers
+
+    # For no apparent reason, split transactions are represented differently depending on whether
+    # the main payee is a transfer ("split transfer"). If not, each part of the split has its own
+    # entry for both accounts and the main memo is dropped. If so, there is only one entry for
+    # the other account with everything lumped together, and the main memo is on that entry.
+
+    # Regular split with transfer -------------------------------------------------------------
+    # ZKB Current Acct   Holy Cow                      Quality of Life  c        Split (1/3)  x
+    # ZKB Current Acct   Transfer: Dan Tracking        Category 1       a        Split (2/3)  y
+    # ZKB Current Acct   Transfer: Dan Tracking        Category 2       b        Split (3/3)  z
+    # Dan Tracking       Transfer: ZKB Current Acct         -           -a       y
+    # Dan Tracking       Transfer: ZKB Current Acct         -           -b       z
+
+    # Split transfer --------------------------------------------------------------------------
+    # ZKB Current Acct   Transfer: UZH Reimbursement   Halbtax          a        Split (1/2)  y
+    # ZKB Current Acct   Transfer: UZH Reimbursement   Reimbursements   b        Split (2/2)  z
+    # UZH Reimbursement  Transfer: ZKB Current Acct         -           - a - b  main
+
+    current_split: list[RawTransactionPartRecord] = []
+    other_sides: list[RawTransactionPartRecord] = []
+    current_split_transfers: dict[tuple[str, str], int] = defaultdict(
+        int)  # (to, from) => amount
+    for ix, part in enumerate(day_transaction_parts):
+        if not is_split(part):
+            assert not current_split
+            assert not other_sides
+            assert not current_split_transfers
+            continue
+        current_split.append(part)
+        if is_transfer(part):
+            transfer_key = get_transfer_key(part)
+            if transfer_key in unmatched_transfers:
+                other_part_ix = unmatched_transfers[transfer_key].pop()
+                other_part = day_transaction_parts[other_part_ix]
+                determine_off_budget(part, other_part)
+                current_split.append(other_part)
+            else:  # This is part of a split transfer
+                from_acc, to_acc, amount = transfer_key
+                current_split_transfers[(from_acc, to_acc)] += amount
+                # Make a fake one so that the notes match.
+                other_part = copy.copy(part)
+                other_part.CategoryGroupCategory = ''  # Is this right?
+                other_part.Account = to_acc
+                other_part.Inflow, other_part.Outflow = part.Outflow, part.Inflow
+                determine_off_budget(part, other_part)
+                current_split.append(other_part)
+        if is_last_part_in_split(part):
+            # We have all the totals of split transfers, so we should be able to match them
+            for (from_acc, to_acc), amount in current_split_transfers.items():
+                transfer_key = (from_acc, to_acc, amount)
+                other_part_ix = unmatched_transfers[transfer_key].pop()
+                # We add a fake part instead.
+                # other_part = day_transaction_parts[other_part_ix]
+                # current_split.append(other_part)
+            current_split_transfers.clear()
+            matched.append(current_split)
+            current_split = []
+            other_sides = []
+    assert not current_split
+    assert not current_split_transfers
+    assert not other_sides
+    assert not any(unmatched_transfers.values()), ", ".join(
+        str(day_transaction_parts[ix])
+        for ixs in unmatched_transfers.values() for ix in ixs)
+    return matched
+
+
+def group_parts(raw_transaction_parts: 'list[RawTransactionPartRecord]'):
+    """Split the rows of a transaction into parts by memo."""
+    grouped_parts: dict[str, list[RawTransactionPartRecord]] = {}
+    for raw_part in raw_transaction_parts:
+        grouped_parts.setdefault(
+            cleaned_memo(raw_part), []).append(raw_part)
+
+    # Merge parts if there's only one actual memo
+    if len(grouped_parts) == 2:
+        one, other = grouped_parts
+        if not one or not other:
+            grouped_parts = {
+                one or other: grouped_parts[one] + grouped_parts[other]}
+    return grouped_parts
+
+
+def friend_groups(usernames: 'list[str]') -> 'list[list[str]]':
+    """Group the users whose budgets are friends, directly or through others."""
+    group = {username: username for username in usernames}
+
+    def find(username: str):
+        while group[username] != username:
+            username = group[username]
+        return username
+    for one, other in (BudgetFriends.objects
+                       .filter(from_budget__budget_of__username__in=usernames,
+                               to_budget__budget_of__username__in=usernames)
+                       .values_list('from_budget__budget_of__username',
+                                    'to_budget__budget_of__username')):
+        group[find(one)] = find(other)
+    groups: dict[str, list[str]] = defaultdict(list)
+    for username in usernames:
+        groups[find(username)].append(username)
+    return list(groups.values())
+
+
+def import_group(imports: 'list[tuple[str, str]]', options: 'dict[str, Any]'
+                 ) -> 'list[tuple[str, float, str]]':
+    """Import for some users one after another, possibly in a worker process.
+    Returns the time each one took and the last line it printed."""
+    results: list[tuple[str, float, str]] = []
+    for user, directory in imports:
+        output = io.StringIO()
+        started = time.perf_counter()
+        try:
+            with redirect_stdout(output):
+                call_command('import_ynab', directory, user=user, **options)
+            lines = output.getvalue().splitlines()
+            summary = lines[-1] if lines else "Done"
+        except Exception as error:
+            summary = f"Failed: {error}"
+        results.append((user, time.perf_counter() - started, summary))
+    return results
+
+
+def match_rows(rows: 'list[list[str]]') -> 'list[MatchedDay]':
+    """Parse some register rows and match them up, in a worker process. Days
+    that can't be matched up are left for the caller to try again."""
+    matched: list[MatchedDay] = []
+    for day_transaction_parts in Command.days(
+            map(RawTransactionPartRecord.from_row, rows)):
+        try:
+            matched.append((day_transaction_parts,
+                            match_day(day_transaction_parts)))
+        except (AssertionError, IndexError):
+            matched.append((day_transaction_parts, None))
+    return matched
+
+
 def determine_off_budget(a: RawTransactionPartRecord, b: RawTransactionPartRecord):
     a.off_budget = bool(
         b.CategoryGroupCategory and not a.CategoryGroupCategory)
@@ -362,6 +832,20 @@ def YNAB_string_to_date(ynab_string: str):
     return date(*[int(i) for i in ynab_string.split('.')][::-1])
 
 
+def row_key(raw_transaction_part: RawTransactionPartRecord):
+    """The parts of a register row that make up its fingerprint."""
+    memo = hashlib.sha256(raw_transaction_part.Memo.encode()).hexdigest()
+    return "|".join((raw_transaction_part.Account, raw_transaction_part.Date,
+                     raw_transaction_part.Payee,
+                     raw_transaction_part.CategoryGroupCategory,
+                     str(raw_transaction_part.TotalInflow()), memo[:16]))
+
+
+def make_fingerprint(keys: 'tuple[str, ...]', occurrence: int):
+    return hashlib.sha256(
+        "\n".join((*keys, str(occurrence))).encode()).hexdigest()
+
+
 def iscomplete(raw_transaction_part: RawTransactionPartRecord):
     return (not is_split(raw_transaction_part)) or is_last_part_in_split(raw_transaction_part)
 
@@ -432,8 +916,7 @@ def parts_to_entries(raw_transaction_parts: 'list[RawTransactionPartRecord]',
             if not raw_category_group_category:  # Payment from/to off-budget account
                 raw_category_group_category = f"{import_off_budget_prefix}🌐 {raw_account}"
 
-            payee = target_budget.payee(raw_payee)
-            payee_account = payee.get_inbox(Account, currency=ynab_currency)
+            payee_account = target_budget.inbox(raw_payee, Account)
             account_entries[payee_account] += -raw_transaction_part_inflow
 
             raw_category, raw_group = split_category_group_category(
@@ -441,7 +924,7 @@ def parts_to_entries(raw_transaction_parts: 'list[RawTransactionPartRecord]',
             category = target_budget.category(
                 raw_category, raw_group, ynab_currency)
 
-            payee_category = payee.get_inbox(Category, currency=ynab_currency)
+            payee_category = target_budget.inbox(raw_payee, Category)
 
             category_entries[category] += raw_transaction_part_inflow
             category_entries[payee_category] -= raw_transaction_part_inflow
@@ -508,7 +991,12 @@ def move_to_payee(target_budget: TargetBudget, account: BaseAccount):
 def merge_accounts(target_budget: TargetBudget, out_of: AccountT, into: AccountT):
     assert out_of.budget == into.budget
     entries = out_of.entries.all()
+    model = entries.model
+    moved = list(entries.values_list('id', flat=True))
+    roll_balances(accounts=[out_of.id, into.id])
+    record_entries_of(-1, sink=out_of.id)
     out_of.entries.update(sink=into)
+    record_entries(model, entry_changes(model, 1, id__in=moved))
     out_of.source_entries.update(source=into)
     out_of.delete()
     for entry in entries:
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandParser
+from datetime import date
+from typing import Any, Optional
+
+from budget.models import materialize_recurrences
+
+
+class Command(BaseCommand):
+    help = ("Copy recurring transactions to every occurrence that is due. "
+            "Meant to be run daily from cron.")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--date", type=date.fromisoformat,
+                            help="Materialize up to this date instead of today")
+
+    def handle(self, *args: Any, date: Optional[date], **options: Any):
+        copies = materialize_recurrences(date)
+        self.stdout.write(f"Materialized {copies} recurring transactions")
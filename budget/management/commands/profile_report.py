@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from pathlib import Path
+from typing import Any, Optional
+import itertools
+
+from budget.profiling import AREAS, profile_dir, load_stats, hottest
+
+
+class Command(BaseCommand):
+    help = ("Show the hottest functions in models.py, forms.py and template "
+            "rendering, from the requests that the sampling profiler saw")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--dir", type=Path,
+                            help="Where the profiles are, by default "
+                            "PROFILE_DIR")
+        parser.add_argument("--view", nargs="+",
+                            help="Only these URL names, by default all of "
+                            "them together")
+        parser.add_argument("--per-view", action="store_true",
+                            help="Show each view separately")
+        parser.add_argument("--areas", nargs="+", choices=AREAS,
+                            default=AREAS)
+        parser.add_argument("--sort", choices=['cumtime', 'tottime', 'calls'],
+                            default='cumtime')
+        parser.add_argument("--limit", type=int, default=15,
+                            help="Functions to show in each area")
+        parser.add_argument("--clear", action="store_true",
+                            help="Delete the profiles afterwards")
+
+    def handle(self, *args: Any, dir: Optional[Path], view: Optional[list[str]],
+               per_view: bool, areas: list[str], sort: str, limit: int,
+               clear: bool, **options: Any):
+        directory = dir or profile_dir()
+        stats = load_stats(directory)
+        if view:
+            missing = set(view) - stats.keys()
+            if missing:
+                raise CommandError(
+                    f"No profiles of {', '.join(sorted(missing))}")
+            stats = {name: stats[name] for name in view}
+        if not stats:
+            raise CommandError(f"No profiles in {directory}; set "
+                               "PROFILE_EVERY or send the profiling header")
+
+        if per_view:
+            groups = list(stats.items())
+        else:
+            total, *rest = stats.values()
+            for other in rest:
+                total.add(other)
+            groups = [(', '.join(sorted(stats)), total)]
+        for name, group in groups:
+            self.stdout.write(f"{name}: {group.total_calls} calls, "  # type: ignore
+                              f"{group.total_tt:.3f}s")  # type: ignore
+            for area in areas:
+                self.stdout.write(f"  {area}")
+                for function in itertools.islice(
+                        hottest(group, sort, [area]), limit):
+                    self.stdout.write(
+                        f"    {function.cumtime:8.3f}s {function.tottime:8.3f}s "
+                        f"{function.calls:8} {function.name}")
+
+        if clear:
+            for path in directory.glob('*.prof'):
+                path.unlink()
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandParser, CommandError
+from typing import Any
+
+from budget.models import (rebuild_balances, check_balances,
+                           check_category_months)
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the stored account balances and category months from "
+            "the entries and verify them")
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--check", action="store_true",
+                            help="Only verify the stored totals")
+
+    def handle(self, *args: Any, check: bool, **options: Any):
+        if not check:
+            rebuild_balances()
+        balances = check_balances()
+        for account, (expected, stored) in sorted(balances.items()):
+            self.stderr.write(
+                f"Balance of {account}: expected {expected}, stored {stored}")
+        months = check_category_months()
+        for (category, month), (expected, stored) in sorted(months.items()):
+            self.stderr.write(f"Category {category} in {month:%Y-%m}: "
+                              f"expected {expected}, stored {stored}")
+        if balances or months:
+            raise CommandError(f"{len(balances)} balances and {len(months)} "
+                               "category months don't match")
+        self.stdout.write("Balances and category months match")
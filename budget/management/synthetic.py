@@ -0,0 +1,185 @@
+"""Synthetic budgets for benchmarks."""
+import random
+from datetime import date, timedelta
+from itertools import combinations
+from typing import Any
+
+from budget import recurrence
+from budget.models import (User, Budget, BudgetFriends, Account, Category,
+                           Transaction, TransactionPart, Cleared, AccountEntry,
+                           CategoryEntry, EntryType, months_between,
+                           rebuild_balances)
+
+
+Flow = tuple[EntryType, Any, Any, int]
+
+
+def bulk_transactions(contents: list[tuple[Transaction, list[Flow]]]):
+    """Insert transactions of one part each, bypassing set_flows(). The stored
+    totals need to be rebuilt afterwards."""
+    return bulk_split_transactions(
+        [(transaction, [flows]) for transaction, flows in contents])
+
+
+def bulk_split_transactions(
+        contents: list[tuple[Transaction, list[list[Flow]]]]):
+    """Same as bulk_transactions(), with the flows of each part."""
+    transactions = Transaction.objects.bulk_create(
+        [transaction for transaction, _ in contents], batch_size=1000)
+    parts = TransactionPart.objects.bulk_create(
+        [TransactionPart(transaction=transaction,
+                         note=f"Part {index + 1}" if len(part_flows) > 1 else "")
+         for transaction, (_, part_flows) in zip(transactions, contents)
+         for index in range(len(part_flows))], batch_size=1000)
+    entries: dict[EntryType, list[Any]] = {AccountEntry: [], CategoryEntry: []}
+    all_flows = (flows for _, part_flows in contents for flows in part_flows)
+    for part, flows in zip(parts, all_flows):
+        for type, source, sink, amount in flows:
+            entries[type] += [type(part=part, source=source, sink=sink, amount=amount),
+                              type(part=part, source=sink, sink=source, amount=-amount)]
+    for type, objs in entries.items():
+        type.objects.bulk_create(objs, batch_size=1000)
+    return transactions
+
+
+def synthetic_budget(name: str, start: date, end: date, *,
+                     categories: int = 20, per_month: int = 100,
+                     seed: int = 0) -> Budget:
+    """A budget with monthly budgeting and income, and random spending."""
+    rng = random.Random(seed)
+    user = User.objects.create(username=name)
+    budget = Budget.objects.create(name=name, budget_of=user)
+    shop = Budget.objects.create(name=f"{name} shop", payee_of=user)
+    account = Account.objects.create(budget=budget, name="Checking",
+                                     currency='CHF')
+    inbox = budget.get_inbox(Category, 'CHF')
+    shop_account = shop.get_inbox(Account, 'CHF')
+    shop_category = shop.get_inbox(Category, 'CHF')
+    spending = [Category.objects.create(budget=budget, name=f"Category {i}",
+                                        currency='CHF', order=i)
+                for i in range(categories)]
+
+    contents: list[tuple[Transaction, list[Flow]]] = []
+    for month in months_between(start, end):
+        budgeted = {category: rng.randrange(100, 50000) for category in spending}
+        contents.append((
+            Transaction(date=month, kind=Transaction.Kind.BUDGETING),
+            [(CategoryEntry, inbox, category, amount)
+             for category, amount in budgeted.items()]))
+        income = sum(budgeted.values())
+        contents.append((
+            Transaction(date=month),
+            [(AccountEntry, shop_account, account, income),
+             (CategoryEntry, shop_category, inbox, income)]))
+        for _ in range(per_month):
+            amount = rng.randrange(100, 20000)
+            contents.append((
+                Transaction(date=month.replace(day=rng.randint(1, 28))),
+                [(AccountEntry, account, shop_account, amount),
+                 (CategoryEntry, rng.choice(spending), shop_category, amount)]))
+    bulk_transactions(contents)
+    rebuild_balances()
+    return budget
+
+
+CURRENCIES = ['CHF', 'EUR', 'USD', 'GBP', 'JPY']
+
+
+def synthetic_ledger(users: int, start: date, end: date, *,
+                     prefix: str = "user", currencies: int = 2,
+                     categories: int = 10, payees: int = 10, friends: int = 2,
+                     per_month: int = 100, seed: int = 0) -> list[Budget]:
+    """Budgets for several users, with a friends graph, payees, several
+    currencies, split, shared and recurring transactions, budgeting and
+    cleared flags. The same arguments always give the same ledger."""
+    rng = random.Random(seed)
+    owners = User.objects.bulk_create(
+        [User(username=f"{prefix}{i}") for i in range(users)])
+    budgets = [Budget.objects.create(name=owner.username, budget_of=owner)
+               for owner in owners]
+    # Friendship goes both ways
+    pairs = set(combinations(range(users), 2))
+    links = rng.sample(sorted(pairs), min(len(pairs), users * friends // 2))
+    BudgetFriends.objects.bulk_create(
+        [BudgetFriends(from_budget=budgets[one], to_budget=budgets[other])
+         for a, b in links for one, other in ((a, b), (b, a))])
+    friends_of: dict[int, list[int]] = {i: [] for i in range(users)}
+    for a, b in links:
+        friends_of[a].append(b)
+        friends_of[b].append(a)
+
+    used = CURRENCIES[:currencies]
+    for i, (owner, budget) in enumerate(zip(owners, budgets)):
+        accounts = {currency: [Account.objects.create(
+            budget=budget, name=f"{name} {currency}", currency=currency)
+            for name in ("Checking", "Savings")] for currency in used}
+        spending = {currency: [Category.objects.create(
+            budget=budget, name=f"Category {n}", currency=currency, order=n)
+            for n in range(categories)] for currency in used}
+        inbox = {currency: budget.get_inbox(Category, currency)
+                 for currency in used}
+        shops = [Budget.objects.create(name=f"{owner.username} payee {n}",
+                                       payee_of=owner)
+                 for n in range(payees)]
+        shop_inboxes = [{currency: (shop.get_inbox(Account, currency),
+                                    shop.get_inbox(Category, currency))
+                         for currency in used} for shop in shops]
+        friend_inboxes = [{currency: budgets[friend].get_inbox(Category, currency)
+                           for currency in used} for friend in friends_of[i]]
+
+        contents: list[tuple[Transaction, list[list[Flow]]]] = []
+        cleared: list[tuple[int, Account, bool]] = []
+
+        def spend(currency: str, amount: int) -> list[Flow]:
+            shop_account, shop_category = rng.choice(shop_inboxes)[currency]
+            flows: list[Flow] = [
+                (AccountEntry, rng.choice(accounts[currency]), shop_account, amount)]
+            if friend_inboxes and rng.random() < 0.1:
+                # Shared with a friend, who pays for half of it
+                share = amount // 2
+                flows.append((CategoryEntry, rng.choice(friend_inboxes)[currency],
+                               shop_category, share))
+                amount -= share
+            flows.append((CategoryEntry, rng.choice(spending[currency]),
+                          shop_category, amount))
+            return flows
+
+        for month in months_between(start, end):
+            for currency in used:
+                budgeted = {category: rng.randrange(100, 50000)
+                            for category in spending[currency]}
+                contents.append((
+                    Transaction(date=month, kind=Transaction.Kind.BUDGETING),
+                    [[(CategoryEntry, inbox[currency], category, amount)
+                      for category, amount in budgeted.items()]]))
+                income = sum(budgeted.values())
+                shop_account, shop_category = shop_inboxes[0][currency]
+                contents.append((
+                    Transaction(date=month),
+                    [[(AccountEntry, shop_account, accounts[currency][0], income),
+                      (CategoryEntry, shop_category, inbox[currency], income)]]))
+            for _ in range(per_month):
+                currency = rng.choice(used)
+                day = month.replace(day=rng.randint(1, 28))
+                parts = 1 if rng.random() < 0.8 else rng.randint(2, 4)
+                part_flows = [spend(currency, rng.randrange(100, 20000))
+                              for _ in range(parts)]
+                contents.append((Transaction(date=day), part_flows))
+                if rng.random() < 0.8:
+                    cleared.append((len(contents) - 1, part_flows[0][0][1],
+                                    day < end - timedelta(days=90)))
+        # Monthly bills that haven't come due by 'end'
+        for currency in used:
+            for _ in range(3):
+                contents.append((
+                    Transaction(date=end + timedelta(days=rng.randint(1, 28)),
+                                recurrence=recurrence.parse('FREQ=MONTHLY')),
+                    [spend(currency, rng.randrange(1000, 200000))]))
+
+        transactions = bulk_split_transactions(contents)
+        Cleared.objects.bulk_create(
+            [Cleared(transaction=transactions[index], account=account,
+                     reconciled=reconciled)
+             for index, account, reconciled in cleared], batch_size=1000)
+    rebuild_balances()
+    return budgets
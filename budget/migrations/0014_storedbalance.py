@@ -0,0 +1,50 @@
+# Generated by Django 4.2.3 on 2026-10-16 09:12
+
+import datetime
+from django.db import migrations, models
+from django.apps.registry import Apps
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.models import Q, Sum
+import django.db.models.deletion
+
+
+def fill_balances(apps: Apps, schema_editor: BaseDatabaseSchemaEditor):
+    StoredBalance = apps.get_model("budget", "StoredBalance")
+    today = datetime.date.today()
+    balances: dict[int, tuple[int, int]] = {}
+    for name in ("AccountEntry", "CategoryEntry"):
+        Entry = apps.get_model("budget", name)
+        balances |= {
+            sink: (past, future)
+            for sink, past, future in (
+                Entry.objects
+                .values('sink')
+                .annotate(past=Sum('amount', default=0,
+                                   filter=Q(part__transaction__date__lte=today)),
+                          future=Sum('amount', default=0,
+                                     filter=Q(part__transaction__date__gt=today)))
+                .values_list('sink', 'past', 'future'))}
+    StoredBalance.objects.bulk_create(
+        StoredBalance(account_id=account, past=past, future=future, as_of=today)
+        for account, (past, future) in balances.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0013_alter_account_currency_alter_budget_initial_currency_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBalance',
+            fields=[
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True,
+                 related_name='stored_balance', serialize=False, to='budget.id')),
+                ('past', models.BigIntegerField(default=0)),
+                ('future', models.BigIntegerField(default=0)),
+                ('as_of', models.DateField(default=datetime.date.today)),
+            ],
+        ),
+        migrations.RunPython(fill_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.3 on 2026-10-16 14:37
+
+from django.db import migrations, models
+from django.apps.registry import Apps
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.models import Q, Sum
+from django.db.models.functions import Trunc
+import django.db.models.deletion
+
+
+def fill_months(apps: Apps, schema_editor: BaseDatabaseSchemaEditor):
+    CategoryEntry = apps.get_model("budget", "CategoryEntry")
+    CategoryMonth = apps.get_model("budget", "CategoryMonth")
+    budgeting = Q(part__transaction__kind='B')
+    CategoryMonth.objects.bulk_create(
+        CategoryMonth(category_id=sink, month=month,
+                      budgeted=budgeted, activity=activity)
+        for sink, month, budgeted, activity in (
+            CategoryEntry.objects
+            .values('sink', month=Trunc('part__transaction__date', 'month'))
+            .annotate(budgeted=Sum('amount', default=0, filter=budgeting),
+                      activity=Sum('amount', default=0, filter=~budgeting))
+            .values_list('sink', 'month', 'budgeted', 'activity')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0014_storedbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryMonth',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True,
+                 primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('budgeted', models.BigIntegerField(default=0)),
+                ('activity', models.BigIntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                 related_name='months', to='budget.category')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='categorymonth',
+            constraint=models.UniqueConstraint(
+                fields=('category', 'month'), name='unique_categorymonth'),
+        ),
+        migrations.RunPython(fill_months, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.3 on 2026-10-16 23:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0015_categorymonth'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('recurrence__isnull', False)), fields=['date'], name='transaction_recurrence_date'),
+        ),
+    ]
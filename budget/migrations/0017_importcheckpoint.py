@@ -0,0 +1,22 @@
+# Generated by Django 4.2.3 on 2026-10-16 23:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0016_transaction_recurrence_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('budget', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='import_checkpoint', serialize=False, to='budget.budget')),
+                ('register_date', models.DateField(null=True)),
+                ('budget_month', models.DateField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-16 23:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0017_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('date', models.DateField()),
+                ('budget', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='budget.budget')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='budget.transaction')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importfingerprint',
+            constraint=models.UniqueConstraint(fields=('budget', 'fingerprint'), name='unique_importfingerprint'),
+        ),
+    ]
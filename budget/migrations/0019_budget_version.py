@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-16 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget', '0018_importfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='budget',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
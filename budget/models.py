@@ -1,30 +1,37 @@
 from .recurrence import RRule
 from . import recurrence
 from .algorithms import sum_by, merge, reroot, double_entrify_by, Debts
-from collections import defaultdict
+from .instrumentation import timed
+from collections import defaultdict, deque
 from typing import (Optional, Iterable, TypeVar, Type, Union, Generic,
-                    Any, ClassVar, Literal, Collection)
+                    Any, ClassVar, Literal, Collection, cast)
 import functools
-from itertools import chain, islice
+import logging
+from itertools import chain, islice, cycle
 from datetime import date, timedelta
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import heapq
 
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
+from django.db import models, connections
 from django import forms
-from django.db.transaction import atomic
+from django.db.transaction import atomic, on_commit
 from django.db.models import (Q, F, Prefetch, Subquery, OuterRef, Value, Case, When,
-                              Min, Max, Sum, Count, Exists, FilteredRelation, expressions,
-                              prefetch_related_objects, aggregates)
-from django.db.models.functions import Coalesce, NullIf
+                              Min, Max, Sum, Count, Exists, expressions,
+                              Window, prefetch_related_objects, aggregates)
+from django.db.models.functions import Coalesce, NullIf, Trunc
 from django.urls import reverse
+from django.core.cache import cache
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.auth.models import User, AnonymousUser, AbstractBaseUser
 
 TYPE_CHECKING = False
 if TYPE_CHECKING:
     from django.db.models.manager import RelatedManager
 
+logger = logging.getLogger(__name__)
+
 
 class JsonArray(expressions.Func):
     output_field = models.JSONField()  # type: ignore
@@ -92,9 +99,21 @@ class Budget(Id):
     initial_currency = models.CharField(max_length=16, blank=True)
     initial_split = models.CharField(max_length=100, blank=True)
 
+    # Increased whenever anything this budget can see changes; see
+    # bump_versions()
+    version = models.BigIntegerField(default=0)
+
     def __str__(self):
         return self.name
 
+    def save(self, *args: Any, **kwargs: Any):
+        # Don't write back a version that may have been bumped since loading
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'version']
+        super().save(*args, **kwargs)
+
     def kind(self):
         return 'budget'
 
@@ -221,38 +240,35 @@ class BaseAccount(Id):
         """Not actually important"""
         return self.id < other.id
 
-    def transactions(self) -> tuple[list['Transaction'], int, int]:
-        if isinstance(self, Account):  # gross
-            field, amount = 'parts__accounts', 'parts__accountentry_set__amount'
-        else:
-            field, amount = 'parts__categories', 'parts__categoryentry_set__amount'
-
-        qs = (Transaction.objects
-              .filter(**{field: self})
-              .annotate(account=F(field), change=Sum(amount)).exclude(change=0)
-              .annotate(cleared_self=FilteredRelation('cleared',
-                                                      condition=Q(cleared__account_id=self.id)),
-                        reconciled=F('cleared_self__reconciled'))
-              .fetch_contents()
-              .order_by('date', '-kind', 'id'))
-        fetch_accounts(qs, self.budget)
-
-        if sum(transaction.do_recurrence() for transaction in set(qs)):
-            return self.transactions()  # Retry
-
-        balance, cleared = 0, 0
-        for transaction in qs:
-            if self.clearable and transaction.reconciled is None:
-                transaction.uncleared = True
-                transaction.running_sum = ''
-            else:
-                cleared += transaction.change
-                transaction.running_sum = cleared
-            if transaction.date and transaction.date > date.today():
-                transaction.is_future = True
-            else:
-                balance += transaction.change
-        return list(reversed(qs)), balance, cleared
+    def register(self) -> 'TransactionQuerySet':
+        """The transactions involving this account, with its change in them."""
+        entry: EntryType = AccountEntry if isinstance(self, Account) else CategoryEntry
+        entries = entry.objects.filter(sink=self.id)
+        change = (entries
+                  .filter(part__transaction=OuterRef('pk'))
+                  .values('part__transaction')
+                  .values(sum=Sum('amount')))
+        return (Transaction.objects
+                .filter(id__in=entries.values('part__transaction'))
+                .annotate(change=Coalesce(Subquery(change), 0))
+                .exclude(change=0)
+                .annotate(reconciled=Subquery(
+                    Cleared.objects
+                    .filter(transaction=OuterRef('pk'), account=self.id)
+                    .values('reconciled'))))
+
+    @timed('transactions')
+    def transactions(self, before: 'Optional[Cursor]' = None,
+                     limit: Optional[int] = None
+                     ) -> tuple[list['Transaction'], int, int]:
+        qs = self.register()
+        entries = running_sums(qs, self.budget, clearable=self.clearable,
+                               before=before, limit=limit)
+        cleared = 0
+        if self.clearable:
+            cleared = (qs.filter(reconciled__isnull=False)
+                       .aggregate(cleared=Sum('change', default=0))['cleared'])
+        return entries, stored_balance(account=self.id), cleared
 
 
 AccountT = TypeVar('AccountT', bound=BaseAccount)
@@ -316,37 +332,33 @@ class Balance:
         # Templates/urls refer to it this way
         return f'owed-{self.currency}-{self.other.id}'
 
-    def transactions(self) -> tuple[list['Transaction'], int, int]:
-        has = dict(AccountEntry.objects
-                   .filter(sink__budget=self.budget.id, source__budget_id=self.other.id,
-                           sink__currency=self.currency)
-                   .values('part__transaction')
-                   .values_list('part__transaction', Sum('amount')))
-        gets = dict(CategoryEntry.objects
-                    .filter(sink__budget=self.budget.id, source__budget_id=self.other.id,
-                            sink__currency=self.currency)
-                    .values('part__transaction')
-                    .values_list('part__transaction', Sum('amount')))
-        qs = (Transaction.objects
-              .filter(id__in=gets.keys() | has.keys())
-              .fetch_contents()
-              .order_by('date', '-kind', 'id'))
-        fetch_accounts(qs, self.budget)
-
-        if sum(transaction.do_recurrence() for transaction in set(qs)):
-            return self.transactions()  # Retry
-
-        total, balance = 0, 0
-        for transaction in qs:
-            change = gets.get(transaction.id, 0) - has.get(transaction.id, 0)
-            total += change
-            transaction.change = change
-            transaction.running_sum = total
-            if transaction.date and transaction.date > date.today():
-                transaction.is_future = True
-            else:
-                balance += transaction.change
-        return list(reversed(qs)), balance, 0
+    def register(self) -> 'TransactionQuerySet':
+        def entries(type: EntryType):
+            return type.objects.filter(sink__budget=self.budget.id,
+                                       source__budget=self.other.id,
+                                       sink__currency=self.currency)
+
+        def change(type: EntryType):
+            return Coalesce(Subquery(entries(type)
+                                     .filter(part__transaction=OuterRef('pk'))
+                                     .values('part__transaction')
+                                     .values(sum=Sum('amount'))), 0)
+        has, gets = AccountEntry, CategoryEntry
+        return (Transaction.objects
+                .filter(Q(id__in=entries(has).values('part__transaction'))
+                        | Q(id__in=entries(gets).values('part__transaction')))
+                .annotate(change=change(gets) - change(has)))
+
+    @timed('transactions')
+    def transactions(self, before: 'Optional[Cursor]' = None,
+                     limit: Optional[int] = None
+                     ) -> tuple[list['Transaction'], int, int]:
+        qs = self.register()
+        entries = running_sums(qs, self.budget, before=before, limit=limit)
+        past = Q(date__lte=date.today())
+        balance = qs.filter(past).aggregate(
+            balance=Sum('change', default=0))['balance']
+        return entries, balance, 0
 
 
 @dataclass
@@ -365,29 +377,28 @@ class Total:
         # Templates/urls refer to it this way
         return 'all-' + self.currency
 
-    def transactions(self) -> tuple[Iterable['Transaction'], int, int]:
+    def register(self) -> 'TransactionQuerySet':
         # TODO: Do we want to include budgets and transfers here?
-        qs = (Transaction.objects
-              .filter(parts__categories__currency=self.currency,
-                      parts__categories__budget=self.budget)
-              .annotate(change=Sum('parts__categoryentry_set__amount'))
-              .exclude(change=0)
-              .fetch_contents()
-              .order_by('date', '-kind', 'id'))
-        fetch_accounts(qs, self.budget)
-
-        if sum(transaction.do_recurrence() for transaction in set(qs)):
-            return self.transactions()  # Retry
-
-        total, balance = 0, 0
-        for transaction in qs:
-            total += transaction.change
-            transaction.running_sum = total
-            if transaction.date and transaction.date > date.today():
-                transaction.is_future = True
-            else:
-                balance += transaction.change
-        return list(reversed(qs)), balance, 0
+        entries = CategoryEntry.objects.filter(sink__budget=self.budget,
+                                               sink__currency=self.currency)
+        change = (entries
+                  .filter(part__transaction=OuterRef('pk'))
+                  .values('part__transaction')
+                  .values(sum=Sum('amount')))
+        return (Transaction.objects
+                .filter(id__in=entries.values('part__transaction'))
+                .annotate(change=Coalesce(Subquery(change), 0))
+                .exclude(change=0))
+
+    @timed('transactions')
+    def transactions(self, before: 'Optional[Cursor]' = None,
+                     limit: Optional[int] = None
+                     ) -> tuple[list['Transaction'], int, int]:
+        entries = running_sums(self.register(), self.budget,
+                               before=before, limit=limit)
+        balance = stored_balance(account__of_category__budget=self.budget,
+                                 account__of_category__currency=self.currency)
+        return entries, balance, 0
 
 
 AccountLike = BaseAccount | Account | Category | Total | Balance
@@ -422,11 +433,38 @@ def connectivity(budgets: list[Budget]) -> dict[Budget, Budget]:
     return result
 
 
+class EntryResolver:
+    """Caches the inboxes of a budget and the spanning trees between budgets,
+    for double-entrifying many parts at once."""
+
+    def __init__(self, in_budget: Budget):
+        self.in_budget = in_budget
+        self.inboxes: dict[tuple[Type[BaseAccount], str], BaseAccount] = {}
+        self.trees: dict[frozenset[int], dict[Budget, Budget]] = {}
+
+    def inbox(self, type: Type[AccountT], currency: str) -> AccountT:
+        if (type, currency) not in self.inboxes:
+            self.inboxes[(type, currency)] = self.in_budget.get_inbox(
+                type, currency)
+        return cast(AccountT, self.inboxes[(type, currency)])
+
+    def tree(self, budgets: list[Budget]) -> dict[Budget, Budget]:
+        """The friendship spanning tree of 'budgets', rooted at this budget."""
+        key = frozenset(budget.id for budget in budgets)
+        if key not in self.trees:
+            tree = connectivity(budgets)
+            reroot(tree, self.in_budget)
+            self.trees[key] = tree
+        return self.trees[key]
+
+
 def double_entrify(in_budget: Budget, type: Type[AccountT],
-                   all_amounts: dict[AccountT, int]):
+                   all_amounts: dict[AccountT, int],
+                   resolver: Optional[EntryResolver] = None):
+    resolver = resolver or EntryResolver(in_budget)
     entries: dict[tuple[AccountT, AccountT], int] = {}
     for currency, amounts in group_by_currency(all_amounts).items():
-        amounts.setdefault(in_budget.get_inbox(type, currency), 0)
+        amounts.setdefault(resolver.inbox(type, currency), 0)
         payees = dict(item for item in amounts.items()
                       if item[0].budget.payee_of_id)
         people = dict(item for item in amounts.items()
@@ -434,8 +472,7 @@ def double_entrify(in_budget: Budget, type: Type[AccountT],
 
         budgets = {account.budget: account for account in people
                    if account.is_inbox()}
-        tree = connectivity(list(budgets))
-        reroot(tree, in_budget)
+        tree = resolver.tree(list(budgets))
         account_tree = {budgets[child]: budgets[parent]
                         for child, parent in tree.items()}
         entries |= double_entrify_by(people, account_tree)
@@ -450,9 +487,129 @@ def double_entrify(in_budget: Budget, type: Type[AccountT],
     )))
 
 
+@atomic
+def set_entries_many(
+        in_budget: Budget,
+        items: Iterable[tuple['TransactionPart',
+                              dict[Account, int], dict[Category, int]]]):
+    """Same as calling part.set_entries(in_budget, accounts, categories) for
+    each item, but inboxes and spanning trees are only looked up once, and the
+    entries that differ from the stored ones are written for all the parts
+    together. Returns the parts, with
+    None for the ones that were deleted because they ended up empty."""
+    resolver = EntryResolver(in_budget)
+    parts: list[TransactionPart] = []
+    flows: dict[EntryType, list[dict[tuple[int, int], int]]] = {
+        AccountEntry: [], CategoryEntry: []}
+    for part, accounts, categories in items:
+        parts.append(part)
+        for model, type, amounts, invisible in (
+                (AccountEntry, Account, accounts, part.invisible_accounts),
+                (CategoryEntry, Category, categories, part.invisible_categories)):
+            flows[model].append(sum_by(
+                ((source.pk, sink.pk), amount) for source, sink, amount
+                in chain(double_entrify(in_budget, type, amounts, resolver),
+                         invisible)))
+    ids = [part.id for part in parts]
+    for model, part_flows in flows.items():
+        stored: dict[int, dict[tuple[int, int], tuple[int, int]]]
+        stored = defaultdict(dict)
+        for id, part_id, source, sink, amount in (
+                model.objects.filter(part__in=ids)
+                .values_list('id', 'part', 'source', 'sink', 'amount')):
+            stored[part_id][(source, sink)] = (id, amount)
+        diff = EntryDiff()
+        for part, new in zip(parts, part_flows):
+            diff += EntryDiff.of(model, part, stored[part.id], new)
+        diff.write(model)
+    empty = [part for part, accounts, categories
+             in zip(parts, flows[AccountEntry], flows[CategoryEntry])
+             if not accounts and not categories]
+    if empty:
+        (TransactionPart.objects
+         .filter(id__in=[part.id for part in empty]).delete())
+    return [None if part in empty else part for part in parts]
+
+
+def remap_entries(parts: Iterable['TransactionPart'],
+                  changes: dict[Any, Any]) -> set['TransactionPart']:
+    """Replace accounts and categories in the entries of 'parts' with others
+    from the same budget, using a few UPDATEs. This is only done for parts
+    where it gives the same entries as set_entries would; the ones that were
+    remapped are returned."""
+    renames = {before: after for before, after in changes.items()
+               if before != after}
+    roll_balances(accounts={account.id for pair in renames.items()
+                            for account in pair})
+
+    def same_budget(before: BaseAccount, after: BaseAccount):
+        return (type(before) is type(after)
+                and before.budget_id == after.budget_id
+                and before.currency == after.currency
+                and not before.is_inbox() and not after.is_inbox())
+
+    remapped: set[TransactionPart] = set()
+    for part in parts:
+        present = {account for source, sink, _ in chain(*part.flows())
+                   for account in (source, sink)}
+        invisible = {account for source, sink, _
+                     in chain(part.invisible_accounts, part.invisible_categories)
+                     for account in (source, sink)}
+        moved = [before for before in renames if before in present]
+        targets = {renames[before] for before in moved}
+        if (moved and len(targets) == len(moved) and not targets & present
+                and all(same_budget(before, renames[before])
+                        and before not in invisible for before in moved)):
+            remapped.add(part)
+
+    for model, flows_of in ((AccountEntry, 0), (CategoryEntry, 1)):
+        pairs = {before: after for before, after in renames.items()
+                 if isinstance(before, model.sink.field.related_model)}
+        if not pairs or not remapped:
+            continue
+        ids = [part.id for part in remapped]
+
+        def renamed(field: str):
+            return Case(*(When(**{field: before}, then=Value(after.id))
+                          for before, after in pairs.items()),
+                        default=F(field),
+                        output_field=models.BigIntegerField())
+        (model.objects.filter(part__in=ids, sink__in=pairs)
+         .update(sink=renamed('sink')))
+        (model.objects.filter(part__in=ids, source__in=pairs)
+         .update(source=renamed('source')))
+        record_entries(model, chain(*(
+            ((sink.id, part.transaction.date, part.transaction.kind, -amount),
+             (pairs[sink].id, part.transaction.date, part.transaction.kind,
+              amount))
+            for part in remapped
+            for _, sink, amount in part.flows()[flows_of]
+            if sink in pairs)))
+    return remapped
+
+
+# Which loader fetch_contents uses by default on each database vendor; see
+# the bench_loaders command. On SQLite the JSON subqueries are about 1.7x
+# faster than the flat query from 1k to 100k transactions. PostgreSQL hasn't
+# been measured: it gets the JSON subqueries only because they were there
+# first, so run bench_loaders against it before trusting or changing that.
+FLAT_CONTENTS: dict[str, bool] = {'sqlite': False}
+
+
 class TransactionQuerySet(models.QuerySet['Transaction']):
-    def fetch_contents(self):
-        """Annotate with notes and account ids using a subquery."""
+    _flat_contents = False
+
+    def fetch_contents(self, flat: Optional[bool] = None):
+        """Annotate with notes and account ids using a subquery. If 'flat', the
+        contents are instead loaded in a second, flat query when the
+        transactions are fetched."""
+        if flat is None:
+            flat = FLAT_CONTENTS.get(connections[self.db].vendor, False)
+        if flat:
+            clone = self._chain()
+            clone._flat_contents = True
+            return clone
+
         def accounts(type: Type[BaseAccount]):
             return Subquery(
                 type.objects
@@ -470,6 +627,27 @@ class TransactionQuerySet(models.QuerySet['Transaction']):
             .values('json'))
         return self.annotate(contents=contents)
 
+    def _clone(self):
+        clone = super()._clone()
+        clone._flat_contents = self._flat_contents
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if (fetched and self._flat_contents
+                and self._iterable_class is models.query.ModelIterable):
+            load_contents(self._result_cache, using=self.db)  # type: ignore
+
+    def with_running_sums(self, clearable: bool = False):
+        """Annotate a register with 'running_total', the sum of 'change' over
+        this transaction and every earlier one. If 'clearable', only reconciled
+        transactions are counted."""
+        change = (Case(When(reconciled__isnull=False, then='change'), default=0)
+                  if clearable else F('change'))
+        return self.annotate(running_total=Window(
+            Sum(change), order_by=[F('date').asc(), F('kind').desc(), F('id').asc()]))
+
     def get_for(self, budget: Budget, id: int):
         try:
             value = self.fetch_contents().get(id=id)
@@ -491,6 +669,109 @@ class TransactionQuerySet(models.QuerySet['Transaction']):
         return MultiTransaction(contents=values)
 
 
+def load_contents(transactions: list['Transaction'], using: str = 'default'):
+    """Fill in 'contents' like fetch_contents does, with one query per
+    5000 transactions."""
+    by_id = {transaction.id: transaction for transaction in transactions}
+    for transaction in transactions:
+        transaction.contents = []
+    ids = list(by_id)
+    for start in range(0, len(ids), 5000):
+        chunk = ids[start:start + 5000]
+        none = Value(None, output_field=models.BigIntegerField())
+        # Only annotations, so the columns line up in the union
+        columns = ('for_transaction', 'for_part', 'part_note', 'index',
+                   'from_id', 'to_id', 'value')
+        parts = (TransactionPart.objects.using(using)
+                 .filter(transaction_id__in=chunk)
+                 .annotate(for_transaction=F('transaction'),
+                           for_part=F('id'), part_note=F('note'),
+                           index=Value(-1), from_id=none, to_id=none,
+                           value=none)
+                 .values_list(*columns))
+
+        def entries(type: EntryType, index: int):
+            return (type.objects.using(using)
+                    .filter(part__transaction_id__in=chunk)
+                    .annotate(for_transaction=F('part__transaction'),
+                              for_part=F('part'), part_note=Value(''),
+                              index=Value(index), from_id=F('source'),
+                              to_id=F('sink'), value=F('amount'))
+                    .values_list(*columns))
+        rows = parts.union(entries(AccountEntry, 2), entries(CategoryEntry, 3),
+                           all=True).order_by('for_part', 'index')
+        contents: dict[int, list[Any]] = {}
+        # The values are plain ints and strings, so skip the ORM's converters
+        with connections[using].cursor() as cursor:
+            cursor.execute(*rows.query.sql_with_params())
+            rows = cursor.fetchall()
+        for transaction, part, note, index, source, sink, amount in rows:
+            if index == -1:
+                contents[part] = [part, note, None, None]
+                by_id[transaction].contents.append(contents[part])
+            else:
+                flows = contents[part][index]
+                if flows is None:
+                    flows = contents[part][index] = []
+                flows.append([source, sink, amount])
+
+
+# The position of a transaction in a register
+Cursor = tuple[date, str, int]
+
+
+def before_cursor(cursor: Cursor) -> Q:
+    """Transactions that come earlier in a register, ordered by
+    ('date', '-kind', 'id')."""
+    day, kind, id = cursor
+    return (Q(date__lt=day)
+            | Q(date=day, kind__gt=kind)
+            | Q(date=day, kind=kind, id__lt=id))
+
+
+def running_sums(qs: TransactionQuerySet, budget: Budget, *,
+                 clearable: bool = False, before: Optional[Cursor] = None,
+                 limit: Optional[int] = None) -> list['Transaction']:
+    """Get the newest 'limit' transactions from a register that come before
+    'before', newest first, and annotate them with their running sums."""
+    window = qs.filter(before_cursor(before)) if before else qs
+    # Earlier rows are kept by the cursor filter, so the window sums are
+    # correct even though only the last 'limit' rows are fetched.
+    windowed = connections[qs.db].features.supports_over_clause
+    if windowed:
+        window = window.with_running_sums(clearable)
+    entries = list(window
+                   .fetch_contents()
+                   .order_by('-date', 'kind', '-id')[:limit])
+    fetch_accounts(entries, budget)
+
+    # Recurrences are normally materialized ahead of time by the scheduler;
+    # this only catches the case where it hasn't run yet today.
+    if any(transaction.is_due() for transaction in entries):
+        materialize_recurrences()
+        return running_sums(qs, budget, clearable=clearable,  # Retry
+                            before=before, limit=limit)
+
+    total = 0
+    if (not windowed and entries
+            and limit is not None and len(entries) == limit):
+        older = qs.filter(before_cursor(entries[-1].cursor()))
+        if clearable:
+            older = older.filter(reconciled__isnull=False)
+        total = older.aggregate(total=Sum('change', default=0))['total']
+    for transaction in reversed(entries):
+        if clearable and transaction.reconciled is None:
+            transaction.uncleared = True
+            transaction.running_sum = ''
+        else:
+            total = (transaction.running_total if windowed
+                     else total + transaction.change)
+            transaction.running_sum = total
+        if transaction.date and transaction.date > date.today():
+            transaction.is_future = True
+    return entries
+
+
 def account_dict(accounts: Iterable[AccountT]):
     return {account.id: account for account in accounts}
 
@@ -498,20 +779,131 @@ def account_dict(accounts: Iterable[AccountT]):
 # when we save something?
 
 
-def fetch_accounts(transactions: Iterable['Transaction'], budget: Budget):
-    """To be called after fetch_contents on the queryset."""
-    local_accounts = account_dict(budget.account_set.all())
-    local_categories = account_dict(budget.category_set.all())
-    other_accounts = account_dict(
-        Account.objects
-        .filter(Q(budget__payee_of=budget.budget_of_id)
-                | Q(budget__friends=budget), name='')
-        .select_related('budget'))
-    other_categories = account_dict(
-        Category.objects
-        .filter(Q(budget__payee_of=budget.budget_of_id)
-                | Q(budget__friends=budget), name='')
-        .select_related('budget'))
+@dataclass
+class Directory:
+    """The accounts and categories whose flows a budget can see, by id."""
+    local_accounts: frozenset[int] = frozenset()
+    local_categories: frozenset[int] = frozenset()
+    accounts: dict[int, Account] = field(default_factory=dict)
+    categories: dict[int, Category] = field(default_factory=dict)
+
+    @staticmethod
+    def load(budget: Budget):
+        local_accounts = account_dict(budget.account_set.all())
+        local_categories = account_dict(budget.category_set.all())
+        other_accounts = account_dict(
+            Account.objects
+            .filter(Q(budget__payee_of=budget.budget_of_id)
+                    | Q(budget__friends=budget), name='')
+            .select_related('budget'))
+        other_categories = account_dict(
+            Category.objects
+            .filter(Q(budget__payee_of=budget.budget_of_id)
+                    | Q(budget__friends=budget), name='')
+            .select_related('budget'))
+        return Directory(frozenset(local_accounts), frozenset(local_categories),
+                         local_accounts | other_accounts,
+                         local_categories | other_categories)
+
+
+def _directory_key(budget_id: int):
+    return f'budget-directory-{budget_id}'
+
+
+def directory(budget: Optional[Budget]) -> Directory:
+    """Get the directory of a budget from the cache, or load it."""
+    if not budget:
+        return Directory()
+    result = cache.get(_directory_key(budget.id))
+    if result is None:
+        result = Directory.load(budget)
+        cache.set(_directory_key(budget.id), result, 60 * 60 * 24)
+    return result
+
+
+def invalidate_directories(budget_ids: Iterable[int]):
+    """Drop the cached directories of these budgets, and of every budget that
+    can see their inboxes."""
+    budget_ids = set(budget_ids)
+    seeing = (Budget.objects
+              .filter(Q(id__in=budget_ids)
+                      | Q(friends__in=budget_ids)
+                      | Q(budget_of__payee_set__in=budget_ids))
+              .values_list('id', flat=True))
+    keys = [_directory_key(id) for id in budget_ids | set(seeing)]
+    # Now for the rest of this transaction, and again after it commits, in
+    # case another process reloaded a directory from before the change
+    cache.delete_many(keys)
+    on_commit(lambda: cache.delete_many(keys))
+
+
+def bump_versions(budget_ids: 'Iterable[int] | models.QuerySet[Any]'):
+    """Increase the versions of these budgets, and of every budget that can
+    see their inboxes."""
+    (Budget.objects
+     .filter(Q(id__in=budget_ids)
+             | Q(friends__in=budget_ids)
+             | Q(budget_of__payee_set__in=budget_ids))
+     .update(version=F('version') + 1))
+
+
+@receiver(post_save, sender=Budget)
+@receiver(post_delete, sender=Budget)
+def _budget_changed(instance: Budget, **kwargs: Any):
+    invalidate_directories([instance.id])
+    if kwargs['signal'] is post_save:
+        bump_versions([instance.id])
+
+
+@receiver(post_save, sender='budget.Account')
+@receiver(post_delete, sender='budget.Account')
+@receiver(post_save, sender='budget.Category')
+@receiver(post_delete, sender='budget.Category')
+def _account_changed(instance: 'BaseAccount', **kwargs: Any):
+    invalidate_directories([instance.budget_id])
+    bump_versions([instance.budget_id])
+
+
+@receiver(post_save, sender='budget.Cleared')
+@receiver(post_delete, sender='budget.Cleared')
+def _cleared_changed(instance: 'Cleared', **kwargs: Any):
+    bump_versions(Account.objects.filter(id=instance.account_id)
+                  .values('budget'))
+
+
+@receiver(m2m_changed, sender='budget.Cleared')
+def _cleared_set_changed(instance: 'Transaction | Account', action: str,
+                         reverse: bool, pk_set: Optional[set[int]],
+                         **kwargs: Any):
+    if action.startswith('post_'):
+        if reverse:
+            bump_versions([instance.budget_id])  # type: ignore
+        else:
+            bump_versions(Account.objects.filter(id__in=pk_set or ())
+                          .values('budget'))
+
+
+@receiver(post_save, sender=BudgetFriends)
+@receiver(post_delete, sender=BudgetFriends)
+def _friends_changed(instance: BudgetFriends, **kwargs: Any):
+    invalidate_directories([instance.from_budget_id, instance.to_budget_id])
+    bump_versions([instance.from_budget_id, instance.to_budget_id])
+
+
+@receiver(m2m_changed, sender=BudgetFriends)
+def _friends_set_changed(instance: Budget, action: str,
+                         pk_set: Optional[set[int]], **kwargs: Any):
+    if action.startswith('post_'):
+        invalidate_directories({instance.id, *(pk_set or ())})
+        bump_versions({instance.id, *(pk_set or ())})
+
+
+@timed('fetch_accounts')
+def fetch_accounts(transactions: Iterable['Transaction'],
+                   budget: Optional[Budget]):
+    """To be called after fetch_contents on the queryset. With no budget,
+    every part and flow is invisible."""
+    visible = directory(budget)
 
     def to_flows(json: list[tuple[int, int, int]],
                  accounts: dict[int, AccountT],
@@ -533,16 +925,16 @@ def fetch_accounts(transactions: Iterable['Transaction'], budget: Budget):
         part = TransactionPart(
             id=json[0], note=json[1], transaction=transaction)
         part.visible_accounts, part.invisible_accounts = to_flows(
-            json[2] or [], local_accounts | other_accounts, Account)
+            json[2] or [], visible.accounts, Account)
         part.visible_categories, part.invisible_categories = to_flows(
-            json[3] or [], local_categories | other_categories, Category)
+            json[3] or [], visible.categories, Category)
         return part
 
     def is_visible(part: TransactionPart):
         # Part visibility: At least one own account
-        return (any(sink.id in local_accounts
+        return (any(sink.id in visible.local_accounts
                     for _, sink, _ in part.visible_accounts)
-                or any(sink.id in local_categories
+                or any(sink.id in visible.local_categories
                        for _, sink, _ in part.visible_categories))
 
     for transaction in transactions:
@@ -604,6 +996,11 @@ class Transaction(models.Model):
     date = models.DateField(default=date.today)
     recurrence = RecurrenceRuleField(null=True, blank=True)
     cleared_account: 'models.ManyToManyField[Account, Cleared]'
+
+    class Meta:  # type: ignore
+        indexes = [models.Index(fields=['date'],
+                                condition=Q(recurrence__isnull=False),
+                                name='transaction_recurrence_date')]
     cleared_account = models.ManyToManyField(
         Account, through='Cleared', related_name='cleared_transaction')
 
@@ -652,6 +1049,9 @@ class Transaction(models.Model):
     def visible(self):
         return any(part.visible() for part in self.visible_parts)
 
+    def cursor(self) -> Cursor:
+        return (self.date, self.kind, self.id)
+
     def clean(self):
         if isinstance(self.date, date) and isinstance(self.recurrence, RRule):
             if self.recurrence.freq in ("HOURLY", "MINUTELY", "SECONDLY"):
@@ -668,6 +1068,31 @@ class Transaction(models.Model):
         part = self.visible_parts[0]
         return next(chain(*part.entries())).currency
 
+    @classmethod
+    def from_db(cls, db: Any, field_names: Any, values: Any):
+        instance = super().from_db(db, field_names, values)
+        instance._saved = (instance.__dict__.get('date'),
+                           instance.__dict__.get('kind'))
+        return instance
+
+    def save(self, *args: Any, **kwargs: Any):
+        key = (self.date, self.kind)
+        moved = self.pk and getattr(self, '_saved', key) != key
+        with atomic():
+            if moved:  # Totals are stored by date and kind
+                roll_balances_of(part__transaction=self)
+                record_entries_of(-1, part__transaction=self)
+            super().save(*args, **kwargs)
+            if moved:
+                record_entries_of(1, part__transaction=self)
+        self._saved = key
+
+    def delete(self, *args: Any, **kwargs: Any):
+        with atomic():
+            roll_balances_of(part__transaction=self)
+            record_entries_of(-1, part__transaction=self)
+            return super().delete(*args, **kwargs)
+
     @atomic
     def copy_to(self, to: 'date'):
         transaction = Transaction(date=to, kind=self.kind)
@@ -679,19 +1104,99 @@ class Transaction(models.Model):
             part.set_flows(*from_part.flows())
         return transaction
 
-    def do_recurrence(self):
-        today = date.today()
-        if not self.recurrence or not self.date or self.date > today:
-            return False
+    @atomic
+    def copy_to_many(self, dates: Collection['date']):
+        """Same as calling copy_to for each date, but with one insert per
+        table."""
+        transactions = Transaction.objects.bulk_create(
+            [Transaction(date=to, kind=self.kind) for to in dates],
+            batch_size=1000)
+        # set_flows deletes parts that end up empty
+        from_parts = [part for part in chain(self.visible_parts,
+                                             self.invisible_parts)
+                      if any(amount for *_, amount in chain(*part.flows()))]
+        if not transactions or not from_parts:
+            return transactions
+        roll_balances(accounts={sink.pk for part in from_parts
+                                for _, sink, _ in chain(*part.flows())})
+        parts = TransactionPart.objects.bulk_create(
+            [TransactionPart(transaction=transaction, note=from_part.note)
+             for transaction in transactions for from_part in from_parts],
+            batch_size=1000)
+        for index, type in enumerate((AccountEntry, CategoryEntry)):
+            entries = [type(source=source, sink=sink, amount=amount, part=part)
+                       for part, from_part in zip(parts, cycle(from_parts))
+                       for source, sink, amount in from_part.flows()[index]
+                       if amount]
+            type.objects.bulk_create(entries, batch_size=1000)
+            record_entries(type, ((entry.sink_id, entry.part.transaction.date,
+                                   self.kind, entry.amount)
+                                  for entry in entries))
+        return transactions
+
+    def is_due(self, today: Optional[date] = None):
+        return bool(self.recurrence and self.date
+                    and self.date <= (today or date.today()))
+
+    def do_recurrence(self, today: Optional[date] = None):
+        """Copy this transaction to every occurrence up to 'today' and move it
+        to the next one. Returns the number of copies made."""
+        today = today or date.today()
+        if not self.is_due(today):
+            return 0
         with atomic():
+            if not (Transaction.objects.select_for_update()
+                    .filter(id=self.id, date=self.date).exists()):
+                return 0  # Someone else got here first
+            copies: list[date] = []
             for copy in self.recurrence.iterate(self.date):
                 if copy <= today:
-                    self.copy_to(copy)
+                    copies.append(copy)
                 else:
+                    self.copy_to_many(copies)
                     self.date = copy
                     self.save()
-                    return True
-            raise RuntimeError("Recurrence stopped early")
+                    return len(copies)
+            # The rule has ended, so this becomes its last occurrence
+            if copies:
+                self.copy_to_many(copies[:-1])
+                self.date = copies[-1]
+            self.recurrence = None
+            self.save()
+            return max(len(copies) - 1, 0)
+
+
+_materialized_on: Optional[date] = None
+
+
+def materialize_recurrences(today: Optional[date] = None) -> int:
+    """Copy every recurring transaction that is due up to 'today'. Returns the
+    number of copies made."""
+    global _materialized_on
+    today = today or date.today()
+    due = list(Transaction.objects
+               .filter(recurrence__isnull=False, date__lte=today)
+               .fetch_contents())
+    fetch_accounts(due, None)  # Copy every part
+    copies = 0
+    for transaction in due:
+        # One broken transaction shouldn't stop the others
+        try:
+            copies += transaction.do_recurrence(today)
+        except Exception:
+            logger.exception("Couldn't materialize recurring transaction %d",
+                             transaction.id)
+    _materialized_on = today
+    return copies
+
+
+def materialize_recurrences_daily():
+    """Run materialize_recurrences if it hasn't run in this process today."""
+    global _materialized_on
+    today = date.today()
+    if _materialized_on != today:
+        _materialized_on = today  # Only one request at a time should do it
+        materialize_recurrences(today)
 
 
 @dataclass
@@ -735,6 +1240,7 @@ class Cleared(models.Model):
                                     related_name='cleared')
     account = models.ForeignKey(Account, on_delete=models.CASCADE,
                                 related_name='cleared')
+    account_id: int
     reconciled = models.BooleanField(default=False)
 
 
@@ -793,31 +1299,41 @@ class TransactionPart(models.Model):
                     accounts: dict[Account, int], categories: dict[Category, int]):
         """Set the contents of this transaction from the perspective of one budget.
         'accounts' and 'categories' both must to sum to zero."""
-        return self.set_flows(double_entrify(in_budget, Account, accounts)
-                              + self.invisible_accounts,
-                              double_entrify(in_budget, Category, categories)
-                              + self.invisible_categories)
+        resolver = EntryResolver(in_budget)
+        return self.set_flows(
+            double_entrify(in_budget, Account, accounts, resolver)
+            + self.invisible_accounts,
+            double_entrify(in_budget, Category, categories, resolver)
+            + self.invisible_categories)
 
     @atomic
     def set_flows(self,
                   accounts: list[tuple[Account, Account, int]],
                   categories: list[tuple[Category, Category, int]]):
-        has_accounts = self.set_flows_of(self.accountentry_set, accounts)
-        has_categories = self.set_flows_of(self.categoryentry_set, categories)
-        if has_accounts or has_categories:
+        self.flow_diff = (self.set_flows_of(self.accountentry_set, accounts)
+                          + self.set_flows_of(self.categoryentry_set, categories))
+        if self.flow_diff.rows:
             return self
         self.delete()
         return None
 
-    def set_flows_of(self, manager: Any, flows: list[tuple[AccountT, AccountT, int]]):
-        manager.all().delete()
-        updates = [manager.model(source=source, sink=sink, amount=amount,
-                                 part=self)
-                   for source, sink, amount in flows if amount]
-        if not updates:
-            return False
-        manager.bulk_create(updates)
-        return True
+    def set_flows_of(self, manager: Any,
+                     flows: list[tuple[AccountT, AccountT, int]]) -> 'FlowDiff':
+        """Write only the entries that differ from the stored ones."""
+        new = sum_by(((source.pk, sink.pk), amount)
+                     for source, sink, amount in flows)
+        stored = {(source, sink): (id, amount) for id, source, sink, amount
+                  in manager.values_list('id', 'source', 'sink', 'amount')}
+        diff = EntryDiff.of(manager.model, self, stored, new)
+        diff.write(manager.model)
+        return FlowDiff(inserted=len(diff.inserted), updated=len(diff.updated),
+                        deleted=len(diff.deleted), rows=len(new))
+
+    def delete(self, *args: Any, **kwargs: Any):
+        with atomic():
+            roll_balances_of(part=self)
+            record_entries_of(-1, part=self)
+            return super().delete(*args, **kwargs)
 
     def tabular(self):
         # Can this be cached?
@@ -828,6 +1344,76 @@ class TransactionPart(models.Model):
         return Row.from_entries(*self.entries(), reconciled)
 
 
+@dataclass
+class EntryDiff:
+    """The entry rows to write to turn the stored entries of some parts into
+    new ones, and what that changes in the stored totals."""
+    deleted: list[int] = field(default_factory=list)
+    updated: list[Any] = field(default_factory=list)
+    inserted: list[Any] = field(default_factory=list)
+    changes: 'list[EntryChange]' = field(default_factory=list)
+
+    @staticmethod
+    def of(model: 'EntryType', part: 'TransactionPart',
+           stored: dict[tuple[int, int], tuple[int, int]],
+           new: dict[tuple[int, int], int]):
+        """'stored' maps the (source, sink) of each entry of the part to its
+        (id, amount), and 'new' maps them to the amounts to have."""
+        day, kind = part.transaction.date, part.transaction.kind
+        return EntryDiff(
+            [id for key, (id, _) in stored.items() if key not in new],
+            [model(id=id, amount=new[key])
+             for key, (id, amount) in stored.items()
+             if key in new and new[key] != amount],
+            [model(source_id=source, sink_id=sink, amount=amount, part=part)
+             for (source, sink), amount in new.items()
+             if (source, sink) not in stored],
+            [*((sink, day, kind, new.get((source, sink), 0) - amount)
+               for (source, sink), (_, amount) in stored.items()),
+             *((sink, day, kind, amount)
+               for (source, sink), amount in new.items()
+               if (source, sink) not in stored)])
+
+    def __add__(self, other: 'EntryDiff'):
+        return EntryDiff(self.deleted + other.deleted,
+                         self.updated + other.updated,
+                         self.inserted + other.inserted,
+                         self.changes + other.changes)
+
+    def write(self, model: 'EntryType'):
+        """One DELETE, UPDATE and INSERT at most, and the stored totals."""
+        roll_balances(accounts=changed_sinks(self.changes))
+        if self.deleted:
+            model.objects.filter(id__in=self.deleted).delete()
+        if self.updated:
+            model.objects.bulk_update(  # type: ignore
+                self.updated, ['amount'], batch_size=1000)
+        if self.inserted:
+            model.objects.bulk_create(  # type: ignore
+                self.inserted, batch_size=1000)
+        record_entries(model, self.changes)
+
+
+@dataclass
+class FlowDiff:
+    """How many entry rows a write to a part touched, and how many it has
+    afterwards."""
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    rows: int = 0
+
+    @property
+    def touched(self):
+        return self.inserted + self.updated + self.deleted
+
+    def __add__(self, other: 'FlowDiff'):
+        return FlowDiff(self.inserted + other.inserted,
+                        self.updated + other.updated,
+                        self.deleted + other.deleted,
+                        self.rows + other.rows)
+
+
 @dataclass
 class Row:
     account: Optional[Account | Budget]
@@ -839,26 +1425,34 @@ class Row:
     @staticmethod
     def from_entries(accounts: dict[Account, int], categories: dict[Category, int],
                      reconciled: Collection[int]):
-        def pop_by_(entries: dict[AccountT, int],
+        def by_amount(entries: dict[AccountT, int]):
+            # In insertion order, so the first match is the same as a scan
+            buckets: defaultdict[tuple[str, int], deque[AccountT]]
+            buckets = defaultdict(deque)
+            for to, value in entries.items():
+                buckets[(to.currency, value)].append(to)
+            return buckets
+
+        def pop_by_(buckets: defaultdict[tuple[str, int], deque[AccountT]],
                     currency: str, amount: int):
-            try:
-                result = next(to for (to, value) in entries.items()
-                              if value == amount and to.currency == currency)
-                del entries[result]
-                if result.is_inbox():
-                    return result.budget
-                return result
-            except StopIteration:
+            bucket = buckets.get((currency, amount))
+            if not bucket:
                 return None
+            result = bucket.popleft()
+            if result.is_inbox():
+                return result.budget
+            return result
 
         amounts = sorted((account.currency, amount)
                          for account, amount
                          in chain(accounts.items(), categories.items()))
         rows: list[Row]
         rows = []
+        account_buckets = by_amount(accounts)
+        category_buckets = by_amount(categories)
         for currency, amount in amounts:
-            account = pop_by_(accounts, currency, amount)
-            category = pop_by_(categories, currency, amount)
+            account = pop_by_(account_buckets, currency, amount)
+            category = pop_by_(category_buckets, currency, amount)
             if account or category:
                 is_reconciled = (account and account.id) in reconciled
                 rows.append(Row(account, category, amount,
@@ -908,6 +1502,279 @@ class CategoryEntry(Entry[Category]):
                              related_name="entries")
 
 
+class StoredBalance(models.Model):
+    """The sum of the entries into an account or category, split into those
+    dated up to 'as_of' and those after it. Kept up to date by
+    record_entries() so that balances don't have to sum the whole history."""
+    account = models.OneToOneField(Id, on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name='stored_balance')
+    account_id: int
+    past = models.BigIntegerField(default=0)
+    future = models.BigIntegerField(default=0)
+    as_of = models.DateField(default=date.today)
+
+
+class CategoryMonth(models.Model):
+    """The entries into a category in one month, split by transaction kind.
+    Kept up to date by record_entries() for the budgeting screen."""
+    class Meta:  # type: ignore
+        constraints = [models.UniqueConstraint(
+            fields=["category", "month"], name="unique_%(class)s")]
+    category = models.ForeignKey(Category, on_delete=models.CASCADE,
+                                 related_name='months')
+    category_id: int
+    month = models.DateField()
+    budgeted = models.BigIntegerField(default=0)
+    activity = models.BigIntegerField(default=0)
+
+
+class ImportCheckpoint(models.Model):
+    """How far a chunked import into a budget got, so that it can be resumed.
+    The last register day and budget month that were committed."""
+    budget = models.OneToOneField(Budget, on_delete=models.CASCADE,
+                                  primary_key=True,
+                                  related_name='import_checkpoint')
+    register_date = models.DateField(null=True)
+    budget_month = models.DateField(null=True)
+
+
+class ImportFingerprint(models.Model):
+    """Identifies the source rows an imported transaction was made from, so
+    that importing a newer export only writes the transactions that changed.
+    'date' is the date of the rows, which the transaction may have left."""
+    class Meta:  # type: ignore
+        constraints = [models.UniqueConstraint(
+            fields=["budget", "fingerprint"], name="unique_%(class)s")]
+    budget = models.ForeignKey(Budget, on_delete=models.CASCADE,
+                               related_name='+')
+    fingerprint = models.CharField(max_length=64)
+    date = models.DateField()
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE,
+                                    related_name='fingerprints')
+    transaction_id: int
+
+
+EntryType = Type[AccountEntry] | Type[CategoryEntry]
+EntryChange = tuple[int, Optional[date], str, int]
+
+
+def entry_changes(type: EntryType, sign: int, **filter: Any) -> list[EntryChange]:
+    """The (sink id, date, kind, amount) sums of the entries matching 'filter'."""
+    return [(sink, day, kind, sign * amount)
+            for sink, day, kind, amount in (type.objects
+                                            .filter(**filter)
+                                            .values_list('sink',
+                                                         'part__transaction__date',
+                                                         'part__transaction__kind')
+                                            .annotate(Sum('amount')))]
+
+
+def changed_sinks(changes: Iterable[EntryChange]) -> set[int]:
+    """The sinks whose stored balances 'changes' would change, leaving out the
+    ones where they cancel out. These are the ones to roll before writing."""
+    return {sink for sink, _ in sum_by(((sink, day), amount)
+                                       for sink, day, _, amount in changes)}
+
+
+def _batches(keys: list[Any], size: int = 100):
+    """Keep the conditions of each UPDATE within what SQLite can parse."""
+    return (keys[i:i + size] for i in range(0, len(keys), size))
+
+
+def _sum_of(when: dict[Any, Q], amounts: dict[Any, int]):
+    """A CASE picking the amount of the key whose condition a row matches."""
+    return Case(*(When(when[key], then=Value(amount))
+                  for key, amount in amounts.items()),
+                default=Value(0), output_field=models.BigIntegerField())
+
+
+def roll_balances(today: Optional[date] = None,
+                  accounts: 'Optional[Iterable[int] | models.QuerySet[Any]]' = None):
+    """Move entries that are no longer in the future into the past balance.
+    Writers pass the accounts and categories they touch, so that they don't
+    lock the rows of other budgets."""
+    today = today or date.today()
+    rows = StoredBalance.objects.filter(as_of__lt=today)
+    if accounts is not None:
+        rows = rows.filter(account__in=accounts)
+    stale = dict(rows.values_list('account', 'as_of'))
+    if not stale:
+        return
+    only = {} if accounts is None else {'sink__in': list(stale)}
+    moved: dict[int, int] = defaultdict(int)
+    for type in (AccountEntry, CategoryEntry):
+        for sink, day, _, amount in entry_changes(
+                type, 1, part__transaction__date__gt=min(stale.values()),
+                part__transaction__date__lte=today, **only):
+            if sink in stale and day and day > stale[sink]:
+                moved[sink] += amount
+    # Only the rows that nobody rolled in the meantime
+    when = {account: Q(account=account, as_of=as_of)
+            for account, as_of in stale.items()}
+    with atomic():
+        for batch in _batches(list(stale)):
+            amounts = {account: moved[account] for account in batch
+                       if moved[account]}
+            changes = ({'past': F('past') + _sum_of(when, amounts),
+                        'future': F('future') - _sum_of(when, amounts)}
+                       if amounts else {})
+            (StoredBalance.objects
+             .filter(functools.reduce(Q.__or__, (when[key] for key in batch)))
+             .update(as_of=today, **changes))
+
+
+def _add_totals(model: Type[models.Model], totals: dict[Any, dict[str, int]],
+                *keys: str):
+    """Add 'totals' to the rows of 'model', creating any that are missing.
+    'keys' are the fields that the keys of 'totals' are made of. All the rows
+    are updated together, with a CASE for each field."""
+    totals = {key: values for key, values in totals.items()
+              if any(values.values())}
+    when = {key: Q(**dict(zip(keys, key))) for key in totals}
+
+    def rows(batch: list[Any]) -> models.QuerySet[Any]:
+        return model.objects.filter(  # type: ignore
+            functools.reduce(Q.__or__, (when[key] for key in batch)))
+
+    def update(keys: list[Any]):
+        updated = 0
+        for batch in _batches(keys):
+            fields = {field: {key: totals[key][field] for key in batch
+                              if totals[key][field]}
+                      for field in totals[batch[0]]}
+            updated += rows(batch).update(**{
+                field: F(field) + _sum_of(when, amounts)
+                for field, amounts in fields.items() if amounts})
+        return updated
+    if update(list(totals)) == len(totals):
+        return
+    existing = {row for batch in _batches(list(totals))
+                for row in rows(batch).values_list(*keys)}
+    missing = [key for key in totals if key not in existing]
+    model.objects.bulk_create(  # type: ignore
+        [model(**dict(zip(keys, key))) for key in missing],
+        ignore_conflicts=True)
+    update(missing)
+
+
+def record_entries(type: EntryType, changes: Iterable[EntryChange]):
+    """Add entries to the stored totals. Removed entries are passed with
+    negated amounts. Call roll_balances() on the changed_sinks() before
+    writing the entries, since it would count the new ones as moving out of
+    the future."""
+    today = date.today()
+    balances: dict[Any, dict[str, int]] = defaultdict(
+        lambda: {'past': 0, 'future': 0})
+    months: dict[Any, dict[str, int]] = defaultdict(
+        lambda: {'budgeted': 0, 'activity': 0})
+    sinks: set[int] = set()
+    for sink, day, kind, amount in changes:
+        sinks.add(sink)
+        if day and day > today:
+            balances[(sink,)]['future'] += amount
+        else:
+            balances[(sink,)]['past'] += amount
+        if type is CategoryEntry and day:
+            field = ('budgeted' if kind == Transaction.Kind.BUDGETING
+                     else 'activity')
+            months[(sink, day.replace(day=1))][field] += amount
+    _add_totals(StoredBalance, balances, 'account_id')
+    _add_totals(CategoryMonth, months, 'category_id', 'month')
+    if sinks:
+        # Parts rewritten without changes count too, their notes may differ
+        bump_versions(type.sink.field.related_model.objects  # type: ignore
+                      .filter(id__in=sinks).values('budget'))
+
+
+def record_entries_of(sign: int, **filter: Any):
+    for type in (AccountEntry, CategoryEntry):
+        record_entries(type, entry_changes(type, sign, **filter))
+
+
+def roll_balances_of(**filter: Any):
+    """roll_balances() for the sinks of the entries matching 'filter'."""
+    for type in (AccountEntry, CategoryEntry):
+        roll_balances(accounts=type.objects.filter(**filter).values('sink'))
+
+
+def stored_balance(**filter: Any) -> int:
+    roll_balances(accounts=StoredBalance.objects.filter(**filter)
+                  .values('account'))
+    return (StoredBalance.objects
+            .filter(**filter)
+            .aggregate(balance=Sum('past', default=0))['balance'])
+
+
+def balances_from_entries(today: date) -> dict[int, tuple[int, int]]:
+    """Compute what the stored balances should be from scratch."""
+    result: dict[int, tuple[int, int]] = {}
+    for type in (AccountEntry, CategoryEntry):
+        result |= {
+            sink: (past, future)
+            for sink, past, future in (
+                type.objects
+                .values('sink')
+                .annotate(past=Sum('amount', default=0,
+                                   filter=Q(part__transaction__date__lte=today)),
+                          future=Sum('amount', default=0,
+                                     filter=Q(part__transaction__date__gt=today)))
+                .values_list('sink', 'past', 'future'))}
+    return result
+
+
+def category_months_from_entries() -> dict[tuple[int, date], tuple[int, int]]:
+    """Compute what the category months should be from scratch."""
+    budgeting = Q(part__transaction__kind=Transaction.Kind.BUDGETING)
+    return {(sink, month): (budgeted, activity)
+            for sink, month, budgeted, activity in (
+                CategoryEntry.objects
+                .values('sink', month=Trunc('part__transaction__date', 'month'))
+                .annotate(budgeted=Sum('amount', default=0, filter=budgeting),
+                          activity=Sum('amount', default=0, filter=~budgeting))
+                .values_list('sink', 'month', 'budgeted', 'activity'))}
+
+
+@atomic
+def rebuild_balances():
+    today = date.today()
+    StoredBalance.objects.all().delete()
+    StoredBalance.objects.bulk_create(
+        StoredBalance(account_id=account, past=past, future=future, as_of=today)
+        for account, (past, future) in balances_from_entries(today).items())
+    CategoryMonth.objects.all().delete()
+    CategoryMonth.objects.bulk_create(
+        CategoryMonth(category_id=category, month=month,
+                      budgeted=budgeted, activity=activity)
+        for (category, month), (budgeted, activity)
+        in category_months_from_entries().items())
+
+
+def _mismatches(expected: dict[Any, Any], stored: dict[Any, Any], zero: Any):
+    return {key: (expected.get(key, zero), stored.get(key, zero))
+            for key in expected.keys() | stored.keys()
+            if expected.get(key, zero) != stored.get(key, zero)}
+
+
+def check_balances() -> dict[int, tuple[tuple[int, int], tuple[int, int]]]:
+    """Returns the expected and stored balances that don't match."""
+    today = date.today()
+    roll_balances(today)
+    stored = {account: (past, future)
+              for account, past, future in (StoredBalance.objects
+                                            .values_list('account', 'past', 'future'))}
+    return _mismatches(balances_from_entries(today), stored, (0, 0))
+
+
+def check_category_months() -> dict[tuple[int, date], tuple[tuple[int, int], tuple[int, int]]]:
+    """Returns the expected and stored category months that don't match."""
+    stored = {(category, month): (budgeted, activity)
+              for category, month, budgeted, activity in (
+                  CategoryMonth.objects
+                  .values_list('category', 'month', 'budgeted', 'activity'))}
+    return _mismatches(category_months_from_entries(), stored, (0, 0))
+
+
 def months_between(start: date, end: date):
     start = start.replace(day=1)
     while start <= end:
@@ -930,10 +1797,13 @@ def groups_for(categories: Iterable[Category]) -> dict[Category, dict[str, list[
     return groups
 
 
+@timed('accounts_overview')
 def accounts_overview(budget: Budget):
     # TODO: Return totals and debts using the corresponding objects
-    past = Q(entries__part__transaction__date__lte=date.today())
-    sum_entries = Sum('entries__amount', filter=past, default=0)
+    roll_balances(accounts=Id.objects.filter(
+        Q(of_account__budget=budget) | Q(of_category__budget=budget))
+        .values('id'))
+    sum_entries = Coalesce('stored_balance__past', 0)
     accounts = (Account.objects
                 .filter(budget=budget)
                 .annotate(balance=sum_entries)
@@ -982,6 +1852,20 @@ def accounts_overview(budget: Budget):
 
 
 def category_balance(budget: Budget, start: date):
+    """Annotate the categories with their balance before the month starting
+    at 'start' and their activity during it."""
+    return (Category.objects
+            .filter(budget=budget)
+            .annotate(
+                balance=Sum(F('months__budgeted') + F('months__activity'),
+                            filter=Q(months__month__lt=start), default=0),
+                change=Sum('months__activity',
+                           filter=Q(months__month=start), default=0))
+            .order_by('order', 'group', 'name'))
+
+
+def category_balance_from_entries(budget: Budget, start: date):
+    """Like category_balance() but summing up the entries directly."""
     end = (start + timedelta(days=31)).replace(day=1)
     return (Category.objects
             .filter(budget=budget)
@@ -0,0 +1,120 @@
+"""Sampling profiler for requests.
+
+Set PROFILE_EVERY to profile one in that many requests, and staff can profile
+any request by sending the PROFILE_HEADER header. Stats are added up per URL
+name and saved in PROFILE_DIR, one file per view and process, for the
+profile_report command to read.
+"""
+import cProfile
+import itertools
+import os
+import pstats
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+_stats: dict[str, pstats.Stats] = {}
+_stats_lock = threading.Lock()
+_requests = itertools.count(1)
+
+
+def profile_dir() -> Path:
+    return Path(getattr(settings, 'PROFILE_DIR', None)
+                or Path(tempfile.gettempdir()) / 'budget_profiles')
+
+
+def _should_profile(request: HttpRequest) -> bool:
+    every: int = getattr(settings, 'PROFILE_EVERY', 0)
+    if every and next(_requests) % every == 0:
+        return True
+    header: str = getattr(settings, 'PROFILE_HEADER', 'X-Profile')
+    return header in request.headers and request.user.is_staff
+
+
+def record(name: str, profile: cProfile.Profile):
+    """Add a profile to the stats of a view, and save them."""
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    with _stats_lock:
+        if name in _stats:
+            _stats[name].add(profile)
+        else:
+            _stats[name] = pstats.Stats(profile)
+        _stats[name].dump_stats(
+            directory / f"{name.replace(os.sep, '_')}.{os.getpid()}.prof")
+
+
+def sampling_profiler(get_response: Callable[[HttpRequest], HttpResponse]):
+    """Profile some requests. This has to come after AuthenticationMiddleware,
+    and it only sees the middleware after it."""
+    def middleware(request: HttpRequest):
+        if not _should_profile(request):
+            return get_response(request)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Something else is profiling already
+            return get_response(request)
+        try:
+            response = get_response(request)
+        finally:
+            profile.disable()
+        match = request.resolver_match
+        record(match.view_name if match else 'unresolved', profile)
+        return response
+    return middleware
+
+
+def load_stats(directory: Path) -> dict[str, pstats.Stats]:
+    """Add up the stats that each process saved for each view."""
+    stats: dict[str, pstats.Stats] = {}
+    for path in sorted(directory.glob('*.prof')):
+        name = path.name.rsplit('.', 2)[0]
+        if name in stats:
+            stats[name].add(str(path))
+        else:
+            stats[name] = pstats.Stats(str(path))
+    return stats
+
+
+class Function(NamedTuple):
+    area: str
+    name: str
+    calls: int
+    tottime: float
+    cumtime: float
+
+
+AREAS = ['models', 'forms', 'templates']
+
+
+def area_of(filename: str) -> str | None:
+    path = Path(filename)
+    if path.parent.name == 'budget' and path.stem in ('models', 'forms'):
+        return path.stem
+    if (path.suffix == '.html' or 'jinja2' in path.parts
+            or 'render_block' in path.parts
+            or 'django' in path.parts and 'template' in path.parts):
+        return 'templates'
+    return None
+
+
+def hottest(stats: pstats.Stats, sort: str = 'cumtime',
+            areas: Iterable[str] = AREAS) -> Iterator[Function]:
+    """The functions of our models and forms, and template rendering, in
+    order of the time spent in them."""
+    areas = set(areas)
+    functions: list[Function] = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in (
+            stats.stats.items()):  # type: ignore
+        area = area_of(filename)
+        if area in areas:
+            functions.append(Function(
+                area, f"{name} ({Path(filename).name}:{line})",
+                calls, tottime, cumtime))
+    return iter(sorted(functions, key=lambda f: getattr(f, sort),
+                       reverse=True))
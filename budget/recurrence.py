@@ -1,22 +1,24 @@
 from dataclasses import dataclass, asdict
 from datetime import date, datetime
 from typing import Iterable, cast
+import functools
 
 from dateutil import rrule
 
 
-@dataclass
+@dataclass(frozen=True)
 class RRule:
+    """Immutable, so parsed rules can be shared between rows."""
     freq: str
     until: str | None = None
     count: int | None = None
     interval: int | None = None
-    byweekday: list[str] | None = None
-    bymonthday: list[int] | None = None
-    byyearday: list[int] | None = None
-    byweekno: list[int] | None = None
-    bymonth: list[int] | None = None
-    bysetpos: list[int] | None = None
+    byweekday: tuple[str, ...] | None = None
+    bymonthday: tuple[int, ...] | None = None
+    byyearday: tuple[int, ...] | None = None
+    byweekno: tuple[int, ...] | None = None
+    bymonth: tuple[int, ...] | None = None
+    bysetpos: tuple[int, ...] | None = None
     wkst: str | int | None = None
 
     def __str__(self):
@@ -25,7 +27,7 @@ class RRule:
                         if part)
 
     def rrule(self, start: date) -> rrule.rrule:
-        return rrule.rrulestr(str(self), dtstart=start)  # type: ignore
+        return _compile(self, start)
 
     def iterate(self, start: date) -> Iterable[date]:
         dtstart = datetime(start.year, start.month, start.day)
@@ -35,6 +37,12 @@ class RRule:
             yield dt.date()
 
 
+@functools.lru_cache(maxsize=1024)
+def _compile(rule: RRule, start: date) -> rrule.rrule:
+    return rrule.rrulestr(str(rule), dtstart=start)  # type: ignore
+
+
+@functools.lru_cache(maxsize=1024)
 def parse(val: str) -> RRule:
     rrule.rrulestr(val)  # Make sure it really parses
     parts = dict(part.split('=') for part in val.split(';'))
@@ -56,14 +64,19 @@ def parse(val: str) -> RRule:
     return result
 
 
+def cache_info():
+    """Hit and miss counts of the parsed and compiled rule caches."""
+    return {'parse': parse.cache_info(), 'rrule': _compile.cache_info()}
+
+
 def _partname(field: str):
     if field == 'byweekday':
         return 'BYDAY'
     return field.upper()
 
 
-def _partvalue(part: str | int | list[str | int] | None):
-    if isinstance(part, list):
+def _partvalue(part: str | int | tuple[str | int, ...] | None):
+    if isinstance(part, tuple):
         return ','.join(str(item) for item in part)
     return str(part)
 
@@ -73,8 +86,8 @@ def _int(value: str | None):
 
 
 def _strlist(value: str | None):
-    return [item for item in value.split(',')] if value else None
+    return tuple(value.split(',')) if value else None
 
 
 def _intlist(value: str | None):
-    return [int(item) for item in value.split(',')] if value else None
+    return tuple(int(item) for item in value.split(',')) if value else None
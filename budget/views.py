@@ -1,7 +1,8 @@
-from typing import Any, Callable, Literal, Collection
+from typing import Callable, Literal, Collection
 from datetime import date
 from collections import defaultdict
 from urllib.parse import urlparse
+import hashlib
 
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import render
@@ -11,30 +12,26 @@ from django.shortcuts import get_object_or_404
 from django.db.transaction import atomic
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse, resolve
-from render_block import render_block_to_string
-import cProfile
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.conf import settings
+import render_block
 
 from .models import (date_range, months_between,
                      BaseAccount, Account, Category, Budget,
                      Transaction, MultiTransaction, Cleared,
                      accounts_overview, budgeting_transaction,
-                     Balance, Total, AccountLike,
-                     prior_budgeting_transaction)
+                     Balance, Total, AccountLike, Cursor,
+                     prior_budgeting_transaction, materialize_recurrences_daily,
+                     bump_versions)
+from .instrumentation import query_budget, timed
 from .forms import (QuickAddForm, TransactionForm,
                     BudgetingForm, BudgetForm, MultiFormSet,
                     AccountManagementFormSet,
                     CategoryManagementFormSet, CurrencyManagementFormSet)
 
-
-def profileit(func: Any):
-    def wrapper(*args: Any, **kwargs: Any):
-        datafn = func.__name__ + ".profile"  # Name the data file sensibly
-        prof = cProfile.Profile()
-        retval = prof.runcall(func, *args, **kwargs)
-        prof.dump_stats(datafn)
-        return retval
-
-    return wrapper
+# Jinja blocks don't go through Template.render
+render_block_to_string = timed('render')(render_block.render_block_to_string)
 
 
 def post_data(get_response: Callable[[HttpRequest], HttpResponse]):
@@ -46,6 +43,16 @@ def post_data(get_response: Callable[[HttpRequest], HttpResponse]):
     return middleware
 
 
+def recurrence_scheduler(get_response: Callable[[HttpRequest], HttpResponse]):
+    """Materialize recurring transactions once a day in each process, in case
+    the materialize_recurrences command isn't run from cron."""
+    def middleware(request: HttpRequest):
+        materialize_recurrences_daily()
+        return get_response(request)
+    return middleware
+
+
+@query_budget(5)
 @login_required
 def index(request: HttpRequest):
     # type: ignore
@@ -93,6 +100,31 @@ def _get_allowed_transactions_or_404(
     return transaction
 
 
+# Transactions shown at once in the account view; keep it even so that the
+# row colors line up.
+PAGE_SIZE = 100
+
+
+def parse_cursor(value: str) -> Cursor:
+    try:
+        day, kind, id = value.split('_')
+        return (date.fromisoformat(day), kind, int(id))
+    except ValueError:
+        raise Http404()
+
+
+def format_cursor(cursor: Cursor):
+    day, kind, id = cursor
+    return f'{day.isoformat()}_{kind}_{id}'
+
+
+def _more_entries(entries: list[Transaction]):
+    """The cursor for the next page, if there might be one."""
+    if len(entries) == PAGE_SIZE:
+        return format_cursor(entries[-1].cursor())
+    return None
+
+
 def parse_transaction_ids(ids: str | list[str]) -> set[int] | Literal['new']:
     if not ids:
         return set()
@@ -107,6 +139,7 @@ def parse_transaction_ids(ids: str | list[str]) -> set[int] | Literal['new']:
         return parse_transaction_ids(ids.split(','))
 
 
+@query_budget(25, account=15, transaction=25, PUT=100, POST=200, DELETE=50)
 @login_required
 def all(request: HttpRequest, budget_id: int,
         account_id: str | None = None,
@@ -126,9 +159,35 @@ def all(request: HttpRequest, budget_id: int,
         transaction_ids = save(request, budget, transaction_ids)
     elif request.method == 'DELETE':
         transaction_ids = delete(budget, transaction_ids)
+    elif 'HX-Request' in request.headers:
+        return _conditional(request, _etag(request, budget), lambda: all_view(
+            request, budget, account_id, transaction_ids))
 
     return all_view(request, budget, account_id, transaction_ids)
 
+
+def _etag(request: HttpRequest, budget: Budget):
+    """Partials only change with the version of the budget, but they also
+    depend on the date, and on the previous URL through HX-Push-Url."""
+    key = '\n'.join((
+        request.get_full_path(), request.headers.get('HX-Target', ''),
+        request.headers.get('HX-Current-URL', ''), date.today().isoformat(),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')))
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return f'"{budget.id}-{budget.version}-{digest}"'
+
+
+def _conditional(request: HttpRequest, etag: str,
+                 view: Callable[[], HttpResponse]):
+    """Respond with 304 Not Modified if the client has the current version."""
+    response = get_conditional_response(request, etag=etag) or view()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('HX-Request', 'HX-Target',
+                                      'HX-Current-URL'))
+    return response
+
 # TODO: The hx-select-oob on these is getting a little out of hand
 
 
@@ -187,6 +246,7 @@ def reconcile(request: HttpRequest, account_id: int):
     if not isinstance(account, Account) or not account.clearable:
         return HttpResponseBadRequest('Wrong kind of account')
     Cleared.objects.filter(account=account).update(reconciled=True)
+    bump_versions([account.budget_id])
     return update_all_view(request, account.budget)
 
 
@@ -226,6 +286,16 @@ def all_view(request: HttpRequest, budget: Budget,
     if account_id:
         account = _get_account_like_or_404(request, budget, account_id)
 
+    if account and 'before' in request.GET:
+        # Next page of the register
+        entries, _, _ = account.transactions(
+            before=parse_cursor(request.GET['before']), limit=PAGE_SIZE)
+        context = {'budget': budget, 'account': account,
+                   'transaction_ids': transaction_ids, 'entries': entries,
+                   'more': _more_entries(entries)}
+        return HttpResponse(render_block_to_string(
+            'budget/partials/account.html', 'entry_rows', context, request))
+
     transaction = _get_allowed_transactions_or_404(budget, transaction_ids)
 
     # I think the prefix isn't needed
@@ -254,12 +324,13 @@ def all_view(request: HttpRequest, budget: Budget,
         return fix_url(render(request, 'budget/partials/edit.html', context))
 
     if account_id:
-        entries, balance, cleared = account.transactions()
+        entries, balance, cleared = account.transactions(limit=PAGE_SIZE)
         initial = ({'date': transaction.date}
                    if isinstance(transaction, Transaction) else {})
         quick_add = QuickAddForm(account, initial=initial, prefix="qa",
                                  autofocus=request.method == 'PUT')
         context |= {'account': account, 'entries': entries,
+                    'more': _more_entries(entries),
                     'balance': balance, 'cleared': cleared,
                     'quick_add': quick_add}
 
@@ -392,6 +463,7 @@ def currency_form(request: HttpRequest, number: int):
         + render_block_to_string('budget/manage.html', 'new_currency', context, request))
 
 
+@query_budget(60, POST=150)
 def manage_accounts(request: HttpRequest, budget_id: int):
     budget = _get_allowed_budget_or_404(request, budget_id)
     categories = (budget.category_set
@@ -470,6 +542,7 @@ def row_form(request: HttpRequest, budget_id: int,
         'budget/partials/edit.html', 'edit_row', context, request))
 
 
+@query_budget(30, POST=100)
 @login_required
 def budgeting(request: HttpRequest, budget_id: int, year: int, month: int):
     budget = _get_allowed_budget_or_404(request, budget_id)